@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from connections import ConnectionUnavailable, StatementCursors
+
+
+class AsyncQueryEngine:
+    # Runs one instance's due collectors concurrently instead of one after another.
+    #
+    # pyodbc is blocking, so each collector runs on a worker thread with its own
+    # connection, driven by an asyncio loop that enforces the concurrency cap and the
+    # per-collector timeout. Connections come from a small pool that lives across
+    # cycles; `max_connections` is also the most sessions the exporter ever opens
+    # on the monitored server. A collector that overruns its timeout has its
+    # statement cancelled on the server (SQLCancel) and its connection discarded.
+    # Each pooled connection keeps its cursors per statement (StatementCursors), so
+    # statements stay prepared whichever connection a collector gets next time.
+    #
+    # Like ConnectionManager, the pool logs in on a background thread: a cycle runs
+    # on the connections that are already open and skips its collectors while there
+    # are none, instead of waiting for a login.
+
+    def __init__(self, connect, max_connections=3, query_timeout=10, name="engine",
+                 cursor_timeout=None, on_login_error=None, on_reconnect=None):
+        self.connect = connect
+        self.max_connections = max(1, max_connections)
+        self.query_timeout = query_timeout
+        # cursor_timeout(name) -> query timeout for a collector's cursor
+        self.cursor_timeout = cursor_timeout
+        self.on_login_error = on_login_error
+        self.on_reconnect = on_reconnect
+        # Twice the connection cap, so threads stuck on a cancelled statement don't starve the pool
+        self.executor = ThreadPoolExecutor(max_workers=self.max_connections * 2, thread_name_prefix=f"{name}-query")
+        self.idle = []
+        # Pooled connection -> its StatementCursors
+        self.statements = {}
+        self.lock = threading.Lock()
+        # Open connections, including ones still busy with a cancelled statement
+        self.opened = 0
+        # Connections the pool should hold, and how many were dropped after a connection error
+        self.wanted = 0
+        self.lost = 0
+        self.logging_in = None
+        self.closed = False
+        self.logger = logging.getLogger(f"AsyncQueryEngine[{name}]")
+
+    def prepare(self, count):
+        # Start opening connections in the background until the pool holds `count`
+        with self.lock:
+            self.wanted = max(self.wanted, min(count, self.max_connections))
+            if self.closed or self.logging_in is not None or self.opened >= self.wanted:
+                return
+            self.logging_in = threading.Thread(target=self._login, name=f"{self.logger.name}-login", daemon=True)
+            self.logging_in.start()
+
+    def _login(self):
+        try:
+            while True:
+                with self.lock:
+                    if self.closed or self.opened >= self.wanted:
+                        return
+                    self.opened += 1
+                try:
+                    conn = self.connect()
+                except Exception as e:
+                    with self.lock:
+                        self.opened -= 1
+                    # Backing off after failed logins is not a new failure
+                    if not isinstance(e, ConnectionUnavailable):
+                        self.logger.error(f"Failed to open a pooled connection: {e}")
+                        if self.on_login_error is not None:
+                            self.on_login_error(e)
+                    return
+                with self.lock:
+                    if self.closed:
+                        self.opened -= 1
+                        conn.close()
+                        return
+                    self.idle.append(conn)
+                    replaced = self.lost > 0
+                    if replaced:
+                        self.lost -= 1
+                if replaced and self.on_reconnect is not None:
+                    self.on_reconnect()
+        finally:
+            with self.lock:
+                self.logging_in = None
+
+    def _acquire(self):
+        with self.lock:
+            return self.idle.pop() if self.idle else None
+
+    def _release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_connections:
+                self.idle.append(conn)
+                return
+        self._discard(conn)
+
+    def _discard(self, conn, lost=False):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.statements.pop(conn, None)
+            self.opened -= 1
+            if lost:
+                self.lost += 1
+
+    def _run_collector(self, conn, name, method, cursors):
+        with self.lock:
+            statements = self.statements.get(conn)
+            if statements is None:
+                statements = self.statements[conn] = StatementCursors(conn)
+        cursor = statements.cursor(self.cursor_timeout(name) if self.cursor_timeout is not None else None)
+        cursors.append(cursor)
+        method(cursor)
+
+    async def _run_one(self, name, method, semaphore):
+        async with semaphore:
+            conn = self._acquire()
+            if conn is None:
+                # A connection dropped earlier in this cycle
+                self.logger.warning(f"No free connection for '{name}', skipping this cycle")
+                return name, 'busy'
+
+            cursors = []
+            future = self.executor.submit(self._run_collector, conn, name, method, cursors)
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=self.query_timeout or None)
+            except asyncio.TimeoutError:
+                self.logger.warning(f"Collector '{name}' exceeded {self.query_timeout}s, cancelling")
+                for cursor in cursors:
+                    try:
+                        cursor.cancel()
+                    except Exception:
+                        pass
+                # The worker thread finishes on its own once the cancel lands (possibly after
+                # this cycle's loop is gone); the connection is closed then rather than handed
+                # to the next collector mid-statement
+                future.add_done_callback(lambda _: self._discard(conn))
+                return name, 'timeout'
+            except Exception as e:
+                # Collectors handle their own query errors; reaching this means the connection broke
+                # (MetricsCollector raises once a collector's query failed with a connection error)
+                self.logger.error(f"Collector '{name}' failed, dropping its connection: {e}")
+                self._discard(conn, lost=True)
+                return name, 'error'
+
+            self._release(conn)
+            return name, 'ok'
+
+    async def _run_all(self, collectors, available):
+        semaphore = asyncio.Semaphore(available)
+        return await asyncio.gather(*(self._run_one(name, method, semaphore) for name, method in collectors))
+
+    def run(self, collectors):
+        # collectors: [(name, method(cursor))]. Returns {name: 'ok' | 'timeout' | 'error' | 'busy' | 'connecting'}
+        with self.lock:
+            available = len(self.idle)
+            # Every session is still held by statements that overran and are being cancelled
+            waiting = 'busy' if self.opened >= self.max_connections else 'connecting'
+        self.prepare(len(collectors))
+        if not available:
+            return {name: waiting for name, _ in collectors}
+        return dict(asyncio.run(self._run_all(collectors, available)))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self._discard(conn)
+        self.executor.shutdown(wait=False, cancel_futures=True)
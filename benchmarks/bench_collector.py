@@ -0,0 +1,203 @@
+# Collector overhead benchmark: runs MetricsCollector.collect() against the fake
+# pyodbc driver (benchmarks/fake_pyodbc.py) and measures what one cycle costs
+# the exporter itself.
+#
+#   python benchmarks/bench_collector.py --cycles 200 --output baseline.json
+#   python benchmarks/bench_collector.py --cycles 200 --compare baseline.json
+#
+# Every collector is forced into the fast tier so each cycle runs them all.
+# Reported per cycle: CPU time, wall time, traced allocation peak, /metrics
+# render time and payload size; plus registry growth between the first and last
+# cycle and per-collector time from sql_exporter_collector_duration_seconds.
+# --compare exits with status 1 when a metric is worse than the baseline by
+# more than --threshold (default 10%).
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_pyodbc
+
+sys.modules['pyodbc'] = fake_pyodbc
+
+from prometheus_client import REGISTRY, generate_latest
+import collector
+
+# Lower is better for every compared metric
+COMPARED = ('cpu_ms_p50', 'cpu_ms_p95', 'wall_ms_p50', 'alloc_peak_kb', 'render_ms_p50', 'payload_kb', 'series_growth')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def series_count():
+    return sum(1 for metric in REGISTRY.collect() for sample in metric.samples
+               if metric.name.startswith('sql_') and not metric.name.startswith('sql_exporter'))
+
+
+def wait_for_connections(metrics_collector):
+    # Logins happen in the background: the serial engine's connection, or the async pools
+    pools = [pool for pool in (metrics_collector.engine, metrics_collector.query_store) if pool is not None]
+    while ((metrics_collector.engine is None and metrics_collector.connections.conn is None)
+           or any(len(pool.idle) < pool.wanted for pool in pools)):
+        time.sleep(0.01)
+
+
+def run(cycles, alloc_cycles, render_every, engine, top_queries_source):
+    names = ('cpu', 'memory', 'io', 'waits', 'sessions', 'blocking', 'db_states', 'jobs', 'errors', 'xevents',
+             'top_queries', 'long_running_queries', 'perf_counters')
+    config = {
+        'server': 'bench', 'username': 'bench', 'password': 'bench',
+        'collection_interval_seconds': 0,
+        'collector_tiers': {name: 0 for name in names},
+        'collection_engine': engine,
+        'collector_timeout_seconds': 0,
+        'top_queries_source': top_queries_source,
+    }
+    metrics_collector = collector.MetricsCollector(config)
+    metrics_collector.connect()
+    wait_for_connections(metrics_collector)
+
+    # Warm-up: the first cycle only establishes counter baselines (and opens the Query Store
+    # pool), the second adds the rates
+    metrics_collector.collect()
+    wait_for_connections(metrics_collector)
+    metrics_collector.collect()
+    series_first = series_count()
+
+    cpu, wall, render, payload = [], [], [], []
+    for cycle in range(1, cycles + 1):
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        metrics_collector.collect()
+        cpu.append((time.process_time() - cpu_start) * 1000)
+        wall.append((time.perf_counter() - wall_start) * 1000)
+        if cycle % render_every == 0 or cycle == cycles:
+            render_start = time.perf_counter()
+            body = generate_latest(REGISTRY)
+            render.append((time.perf_counter() - render_start) * 1000)
+            payload.append(len(body))
+    series_last = series_count()
+
+    per_collector = {}
+    for name in names:
+        total = REGISTRY.get_sample_value('sql_exporter_collector_duration_seconds_sum', {'instance': 'bench', 'collector': name})
+        count = REGISTRY.get_sample_value('sql_exporter_collector_duration_seconds_count', {'instance': 'bench', 'collector': name})
+        if count:
+            per_collector[name] = round(total / count * 1000, 3)
+
+    # Allocations are traced separately; tracemalloc slows everything it watches
+    peaks = []
+    tracemalloc.start()
+    for _ in range(alloc_cycles):
+        tracemalloc.reset_peak()
+        metrics_collector.collect()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+    metrics_collector.close()
+
+    return {
+        'cpu_ms_p50': statistics.median(cpu),
+        'cpu_ms_p95': percentile(cpu, 0.95),
+        'wall_ms_p50': statistics.median(wall),
+        'alloc_peak_kb': max(peaks) / 1024 if peaks else 0,
+        'render_ms_p50': statistics.median(render),
+        'payload_kb': max(payload) / 1024,
+        'series_first': series_first,
+        'series_last': series_last,
+        'series_growth': series_last - series_first,
+        'collector_ms_mean': per_collector,
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"\n{'metric':<16} {'baseline':>12} {'current':>12} {'change':>9}")
+    for key in COMPARED:
+        old, new = baseline['results'].get(key), results[key]
+        if old is None:
+            continue
+        if old:
+            change = (new - old) / old
+        else:
+            change = 0.0 if new <= 0 else float('inf')
+        flag = '  REGRESSION' if change > threshold else ''
+        print(f"{key:<16} {old:>12.2f} {new:>12.2f} {change:>8.1%}{flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collector overhead benchmark')
+    parser.add_argument('--cycles', type=int, default=200)
+    parser.add_argument('--alloc-cycles', type=int, default=5)
+    parser.add_argument('--render-every', type=int, default=10)
+    parser.add_argument('--engine', choices=('serial', 'async'), default='serial')
+    parser.add_argument('--top-queries-source', choices=('plan_cache', 'query_store'), default='plan_cache')
+    parser.add_argument('--waits', type=int, default=fake_pyodbc.DEFAULT_SIZES['waits'])
+    parser.add_argument('--files', type=int, default=fake_pyodbc.DEFAULT_SIZES['files'])
+    parser.add_argument('--plans', type=int, default=fake_pyodbc.DEFAULT_SIZES['plans'])
+    parser.add_argument('--sessions', type=int, default=fake_pyodbc.DEFAULT_SIZES['sessions'])
+    parser.add_argument('--fixtures', help='JSON file of recorded result sets keyed by query name')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write results as JSON')
+    parser.add_argument('--compare', help='Baseline JSON written by --output')
+    parser.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args()
+
+    sizes = {'waits': args.waits, 'files': args.files, 'plans': args.plans, 'sessions': args.sessions}
+    fake_pyodbc.configure(sizes=sizes, fixtures=args.fixtures, seed=args.seed)
+    results = run(args.cycles, args.alloc_cycles, args.render_every, args.engine, args.top_queries_source)
+
+    for key, value in results.items():
+        if key != 'collector_ms_mean':
+            print(f"{key:<16} {value:>12.2f}")
+    print('\nmean ms per collector')
+    for name, ms in sorted(results['collector_ms_mean'].items(), key=lambda item: -item[1]):
+        print(f"  {name:<22} {ms:>10.3f}")
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'engine': args.engine,
+        'top_queries_source': args.top_queries_source,
+        'cycles': args.cycles,
+        'sizes': sizes,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('sizes') != sizes:
+            print(f"\nWarning: baseline was recorded with sizes {baseline.get('sizes')}")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nRegressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Series churn benchmark: simulates top-query / long-running-query label churn
+# and compares registry size with and without SeriesTracker eviction.
+#
+#   python benchmarks/bench_series_churn.py --cycles 5000
+#
+# With eviction, series count, /metrics payload and traced memory stay flat;
+# without it they grow linearly with the number of cycles.
+import argparse
+import os
+import random
+import string
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prometheus_client import CollectorRegistry, Gauge, generate_latest
+from series import SeriesTracker
+
+
+def random_text(rng, length=500):
+    return ''.join(rng.choice(string.ascii_letters + ' ') for _ in range(length))
+
+
+def run(cycles, evict, top_n, sessions, report_every, seed=42):
+    rng = random.Random(seed)
+    registry = CollectorRegistry()
+    top_query = Gauge('bench_top_query_cpu_ms', 'Top Queries by CPU', ['instance', 'query_text_short', 'database'], registry=registry)
+    long_running = Gauge('bench_long_running_seconds', 'Long Running Queries', ['instance', 'session_id', 'database'], registry=registry)
+    tracker = SeriesTracker(top_query, long_running)
+
+    # A pool of statements that keep re-entering the top N, plus fresh ad-hoc text every cycle
+    pool = [random_text(rng) for _ in range(top_n * 5)]
+
+    tracemalloc.start()
+    results = []
+    for cycle in range(1, cycles + 1):
+        tracker.begin()
+        for i in range(top_n):
+            text = rng.choice(pool) if i % 2 else random_text(rng)
+            labels = ('bench', text, f"db{i % 4}")
+            if evict:
+                tracker.labels(top_query, *labels).set(rng.random() * 1000)
+            else:
+                top_query.labels(*labels).set(rng.random() * 1000)
+        for _ in range(sessions):
+            labels = ('bench', str(rng.randint(51, 32767)), 'db0')
+            if evict:
+                tracker.labels(long_running, *labels).set(rng.random() * 60)
+            else:
+                long_running.labels(*labels).set(rng.random() * 60)
+        if evict:
+            tracker.sweep()
+
+        if cycle % report_every == 0 or cycle == cycles:
+            payload = generate_latest(registry)
+            series = sum(len(metric.samples) for metric in registry.collect())
+            current, _ = tracemalloc.get_traced_memory()
+            results.append((cycle, series, len(payload), current))
+    tracemalloc.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Series churn benchmark')
+    parser.add_argument('--cycles', type=int, default=2000)
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--report-every', type=int, default=250)
+    args = parser.parse_args()
+
+    for evict in (False, True):
+        print(f"\n{'with' if evict else 'without'} eviction")
+        print(f"{'cycle':>8} {'series':>10} {'payload_kb':>12} {'traced_kb':>12}")
+        for cycle, series, payload, traced in run(args.cycles, evict, args.top_n, args.sessions, args.report_every):
+            print(f"{cycle:>8} {series:>10} {payload / 1024:>12.1f} {traced / 1024:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
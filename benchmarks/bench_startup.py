@@ -0,0 +1,141 @@
+# Startup benchmark: how long the exporter takes from launch to its first /metrics
+# response, and how much memory it holds once it is collecting.
+#
+#   python benchmarks/bench_startup.py --runs 10
+#   python benchmarks/bench_startup.py --binary dist/sql_metrics_collector/sql_metrics_collector
+#
+# Each run starts the exporter in a fresh process from a temporary directory holding
+# its config.yaml. From source, pyodbc is replaced by benchmarks/fake_pyodbc.py (its
+# own import is included in the time); a --binary build uses its real driver, which
+# doesn't matter here since logins happen in the background. The first run is the
+# cold start (no parsed copy of metrics.yaml yet); the others are warm starts.
+# With --max-ms, reports how far each is from that target and exits with status 1
+# when either is above it.
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+
+BOOTSTRAP = (
+    f"import sys; sys.path[:0] = [{BENCHMARKS!r}, {ROOT!r}]; "
+    "import fake_pyodbc; sys.modules['pyodbc'] = fake_pyodbc; "
+    # Small result sets: generating the default ones would compete with startup for the GIL
+    "fake_pyodbc.configure(sizes={'waits': 500, 'files': 50, 'plans': 1000, 'sessions': 200}); "
+    "import main; main.main()"
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_kb(pid):
+    # Resident set size from /proc (Linux); None elsewhere
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def start_once(directory, command, runtime_metrics, settle):
+    port = free_port()
+    config = {
+        'server': 'bench', 'username': 'bench', 'password': 'bench',
+        'collection_interval_seconds': 1,
+        'export_port': port,
+        'runtime_metrics': runtime_metrics,
+    }
+    with open(os.path.join(directory, 'config.yaml'), 'w') as f:
+        # JSON is valid YAML
+        json.dump(config, f)
+
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Exporter exited with status {process.returncode}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1) as response:
+                    body = response.read()
+                break
+            except OSError:
+                time.sleep(0.002)
+        start_ms = (time.perf_counter() - started) * 1000
+
+        rss = []
+        deadline = time.monotonic() + settle
+        while time.monotonic() < deadline:
+            rss.append(rss_kb(process.pid))
+            time.sleep(0.25)
+        return start_ms, len(body), [value for value in rss if value is not None]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exporter startup benchmark')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--settle', type=float, default=3.0, help='Seconds of collection sampled for RSS (0 to skip)')
+    parser.add_argument('--binary', help='Exporter executable to measure instead of main.py')
+    parser.add_argument('--runtime-metrics', action='store_true', help="Keep prometheus_client's process/platform collectors")
+    parser.add_argument('--max-ms', type=float, help='Target start time; exit with status 1 above it')
+    parser.add_argument('--output', help='Write results as JSON')
+    args = parser.parse_args()
+
+    command = [os.path.abspath(args.binary)] if args.binary else [sys.executable, '-c', BOOTSTRAP]
+    directory = tempfile.mkdtemp(prefix='exporter-startup-')
+    try:
+        runs = [start_once(directory, command, args.runtime_metrics, args.settle if i == args.runs - 1 else 0)
+                for i in range(args.runs)]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    start_ms = [run[0] for run in runs]
+    rss = runs[-1][2]
+    results = {
+        'cold_start_ms': start_ms[0],
+        'warm_start_ms_p50': statistics.median(start_ms[1:]) if len(start_ms) > 1 else None,
+        'start_ms_max': max(start_ms),
+        'payload_kb': runs[-1][1] / 1024,
+        'rss_kb_start': rss[0] if rss else None,
+        'rss_kb_end': rss[-1] if rss else None,
+        'rss_kb_max': max(rss) if rss else None,
+    }
+    for key, value in results.items():
+        print(f"{key:<18} {value:>12.2f}" if value is not None else f"{key:<18} {'n/a':>12}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'binary': args.binary, 'runs': args.runs, 'results': results}, f, indent=2)
+
+    if args.max_ms is not None:
+        print()
+        above = False
+        for key in ('cold_start_ms', 'warm_start_ms_p50'):
+            if results[key] is not None:
+                gap = results[key] - args.max_ms
+                above = above or gap > 0
+                print(f"{key:<18} {gap:+10.2f} ms {'over' if gap > 0 else 'under'} the {args.max_ms:.0f} ms target")
+        if above:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+# Fake pyodbc driver for benchmarks.
+#
+# Stands in for the real module (sys.modules['pyodbc'] = fake_pyodbc) and answers
+# every query in queries.py with generated result sets of realistic size, so the
+# exporter's own overhead can be measured without a SQL Server. Cumulative
+# counters (waits, file stats, query stats) advance on every read for a fraction
+# of the rows, like a busy server, so delta and top-N code paths do real work.
+#
+# Recorded result sets can be replayed instead: configure(fixtures='rows.json')
+# with {"GET_WAIT_STATS": [{"wait_type": ..., ...}, ...], ...}, keyed by the
+# constant names in queries.py.
+import json
+import random
+import re
+from collections import namedtuple
+
+import queries
+import metric_specs
+
+DEFAULT_SIZES = {
+    'waits': 5000,
+    'files': 2000,
+    'plans': 100000,
+    'sessions': 10000,
+    'databases': 200,
+    'jobs': 50,
+    'query_store_plans': 500,   # per database, in query_store mode
+    'churn': 0.02,   # fraction of counter rows that advance between reads
+}
+
+_settings = {'sizes': dict(DEFAULT_SIZES), 'fixtures': {}, 'seed': 42}
+_servers = {}
+
+
+class Error(Exception):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+class OperationalError(DatabaseError):
+    pass
+
+
+class ProgrammingError(DatabaseError):
+    pass
+
+
+def configure(sizes=None, fixtures=None, seed=42):
+    _settings['sizes'] = dict(DEFAULT_SIZES, **(sizes or {}))
+    _settings['seed'] = seed
+    _settings['fixtures'] = {}
+    if fixtures:
+        with open(fixtures) as f:
+            _settings['fixtures'] = json.load(f)
+    _servers.clear()
+
+
+def _table(name, columns):
+    return namedtuple(name, columns)
+
+
+CpuRow = _table('CpuRow', 'timestamp age_ms SQLProcessUtilization SystemIdle OtherProcessUtilization')
+MemoryRow = _table('MemoryRow', 'physical_memory_in_use_kb large_page_allocations_kb page_fault_count')
+IoRow = _table('IoRow', 'database_name logical_name num_of_reads num_of_bytes_read io_stall_read_ms '
+                        'num_of_writes num_of_bytes_written io_stall_write_ms')
+WaitRow = _table('WaitRow', 'wait_type waiting_tasks_count wait_time_ms signal_wait_time_ms')
+ExceptionRow = _table('ExceptionRow', 'timestamp')
+XePositionRow = _table('XePositionRow', 'file_name file_offset has_lock_timeout_events')
+XeEventRow = _table('XeEventRow', 'object_name file_name file_offset event_data')
+Session = _table('Session', 'session_id status blocking_session_id wait_time database_name')
+SessionCountRow = _table('SessionCountRow', 'status database_name session_count blocked_count')
+BlockingEdgeRow = _table('BlockingEdgeRow', 'session_id blocking_session_id wait_time')
+QueryStatsRow = _table('QueryStatsRow', 'sql_handle statement_start_offset statement_end_offset plan_handle query_hash query_plan_hash '
+                                        'execution_count total_worker_time total_logical_io total_elapsed_time')
+SampleRow = _table('SampleRow', 'cpu_percent active_requests blocked_requests')
+DatabaseNameRow = _table('DatabaseNameRow', 'name')
+QueryStoreRow = _table('QueryStoreRow', 'plan_id runtime_stats_interval_id query_hash query_plan_hash '
+                                        'execution_count total_worker_time total_logical_io total_elapsed_time')
+QueryStoreTextRow = _table('QueryStoreTextRow', 'query_text')
+StatementTextRow = _table('StatementTextRow', 'query_text')
+PlanDatabaseRow = _table('PlanDatabaseRow', 'plan_handle database_name')
+LongRunningRow = _table('LongRunningRow', 'session_id duration_seconds query_hash query_plan_hash query_text database_name')
+JobRow = _table('JobRow', 'job_name failed')
+DbStateRow = _table('DbStateRow', 'name state_desc is_online')
+PerfCounterRow = _table('PerfCounterRow', 'object counter counter_instance current_value cumulative_value')
+
+STATEMENT = ("SELECT o.order_id, o.customer_id, SUM(l.quantity * l.price) AS total "
+             "FROM dbo.orders o JOIN dbo.order_lines l ON l.order_id = o.order_id "
+             "WHERE o.created_at >= '2024-01-01' AND o.status = 3 GROUP BY o.order_id, o.customer_id ")
+# event_data of an error_reported event as system_health records it
+XE_ERROR = ('<event name="error_reported" package="sqlserver" timestamp="2024-05-01T10:00:00.000Z">'
+            '<data name="error_number"><value>{error_number}</value></data>'
+            '<data name="severity"><value>{severity}</value></data>'
+            '<data name="state"><value>1</value></data>'
+            '<data name="user_defined"><value>false</value></data>'
+            '<data name="category"><value>2</value><text>SERVER</text></data>'
+            '<data name="message"><value>' + 'x' * 200 + '</value></data>'
+            '<action name="session_id" package="sqlserver"><value>57</value></action>'
+            '</event>')
+
+
+class FakeServer:
+    # Result sets of one simulated instance; state survives reconnects
+
+    def __init__(self, name):
+        sizes = _settings['sizes']
+        self.rng = random.Random(f"{_settings['seed']}:{name}")
+        self.sizes = sizes
+        self.ms_ticks = 10 * 3600 * 1000
+        rng = self.rng
+        databases = [f"db{i:03d}" for i in range(sizes['databases'])]
+        self.databases = databases
+
+        self.files = [
+            IoRow(databases[i % len(databases)], f"file{i}",
+                  rng.randint(1000, 10**6), rng.randint(10**6, 10**9), rng.randint(1000, 10**6),
+                  rng.randint(1000, 10**6), rng.randint(10**6, 10**9), rng.randint(1000, 10**6))
+            for i in range(sizes['files'])
+        ]
+        self.waits = [
+            WaitRow(f"WAIT_TYPE_{i}", rng.randint(1, 10**6), rng.randint(10**3, 10**8), rng.randint(0, 10**5))
+            for i in range(sizes['waits'])
+        ]
+        statuses = ('running', 'runnable', 'suspended', 'sleeping')
+        self.sessions = [
+            # Every 20 sessions form one blocking chain three requests deep
+            Session(51 + i, statuses[i % len(statuses)], (51 + i - 1) if 1 <= i % 20 <= 3 else 0,
+                    rng.randint(0, 60000), databases[i % len(databases)])
+            for i in range(sizes['sessions'])
+        ]
+        self.plans = [
+            QueryStatsRow(i.to_bytes(8, 'big') * 5, 0, -1, (i + 7).to_bytes(8, 'big') * 8,
+                          f"0x{(i // 4):016X}", f"0x{i:016X}",
+                          rng.randint(1, 10**4), rng.randint(10**3, 10**9), rng.randint(10, 10**7), rng.randint(10**3, 10**9))
+            for i in range(sizes['plans'])
+        ]
+        self.plan_databases = {row.plan_handle: databases[i % len(databases)] for i, row in enumerate(self.plans)}
+        self.jobs = [JobRow(f"job{i}", 1) for i in range(sizes['jobs'])]
+        self.db_states = [DbStateRow(db, 'ONLINE', 1) for db in databases]
+        self.perf_counters = [
+            PerfCounterRow('General Statistics', 'User Connections', '', 250, None),
+            PerfCounterRow('Buffer Manager', 'Page life expectancy', '', 3600, None),
+            PerfCounterRow('Memory Manager', 'Memory Grants Pending', '', 0, None),
+            PerfCounterRow('SQL Statistics', 'Batch Requests/sec', '', None, 10**6),
+            PerfCounterRow('SQL Statistics', 'SQL Compilations/sec', '', None, 10**5),
+            PerfCounterRow('Locks', 'Lock Waits/sec', '_Total', None, 10**4),
+        ]
+        self.exception_ticks = []
+        self.query_stores = {}
+        self.xe_events = []
+        self.xe_buffers = 0
+
+    def _advance(self, rows, counter_fields):
+        # Bump the counters of a random subset of rows, like activity between two reads
+        rng = self.rng
+        count = max(1, int(len(rows) * self.sizes['churn'])) if rows else 0
+        for _ in range(count):
+            i = rng.randrange(len(rows))
+            row = rows[i]
+            rows[i] = row._replace(**{field: getattr(row, field) + rng.randint(1, 1000) for field in counter_fields})
+
+    def cpu_usage(self, last_timestamp, max_age_ms):
+        self.ms_ticks += 60000
+        first = max(self.ms_ticks - 256 * 60000, self.ms_ticks - max_age_ms)
+        rows = []
+        for timestamp in range(self.ms_ticks - 255 * 60000, self.ms_ticks + 1, 60000):
+            if timestamp > first and (timestamp > last_timestamp or last_timestamp > self.ms_ticks):
+                process = self.rng.randint(5, 60)
+                idle = self.rng.randint(0, 100 - process)
+                rows.append(CpuRow(timestamp, self.ms_ticks - timestamp, process, idle, 100 - process - idle))
+        return rows
+
+    def memory(self):
+        return [MemoryRow(64 * 1024 * 1024, 0, self.rng.randint(10**6, 10**7))]
+
+    def io_stats(self, max_rows):
+        self._advance(self.files, ('num_of_reads', 'num_of_bytes_read', 'io_stall_read_ms',
+                                   'num_of_writes', 'num_of_bytes_written', 'io_stall_write_ms'))
+        return sorted(self.files, key=lambda row: row.io_stall_read_ms + row.io_stall_write_ms, reverse=True)[:max_rows]
+
+    def wait_stats(self, max_rows):
+        self._advance(self.waits, ('waiting_tasks_count', 'wait_time_ms', 'signal_wait_time_ms'))
+        return sorted(self.waits, key=lambda row: row.wait_time_ms, reverse=True)[:max_rows]
+
+    def exceptions(self, last_timestamp, max_age_ms):
+        for _ in range(self.rng.randint(0, 5)):
+            self.exception_ticks.append(self.ms_ticks + self.rng.randint(1, 59999))
+        self.exception_ticks = sorted(self.exception_ticks)[-256:]
+        return [ExceptionRow(t)
+                for t in self.exception_ticks if t > last_timestamp and t > self.ms_ticks - max_age_ms][:1000]
+
+    def _write_xe_buffers(self):
+        # A few event_file buffers per read; a new file every 100 buffers
+        rng = self.rng
+        for _ in range(rng.randint(0, 3)):
+            self.xe_buffers += 1
+            position = (f"system_health_0_{self.xe_buffers // 100:018d}.xel", (self.xe_buffers % 100) * 65536)
+            for _ in range(rng.randint(1, 5)):
+                kind = rng.random()
+                if kind < 0.1:
+                    self.xe_events.append(XeEventRow('xml_deadlock_report', *position, None))
+                elif kind < 0.2:
+                    self.xe_events.append(XeEventRow('lock_timeout', *position, None))
+                else:
+                    error_number, severity = rng.choice(((1222, 16), (17830, 20), (18456, 14), (823, 24)))
+                    self.xe_events.append(XeEventRow('error_reported', *position, XE_ERROR.format(error_number=error_number, severity=severity)))
+        self.xe_events = self.xe_events[-2000:]
+
+    def xe_position(self, session):
+        self._write_xe_buffers()
+        if not self.xe_events:
+            return []
+        return [XePositionRow(self.xe_events[-1].file_name, self.xe_events[-1].file_offset, 1)]
+
+    def xe_events_after(self, session, file_name, file_offset, max_rows):
+        self._write_xe_buffers()
+        return [row for row in self.xe_events if (row.file_name, row.file_offset) > (file_name, file_offset)][:max_rows]
+
+    def active_sessions(self):
+        counts = {}
+        for session in self.sessions:
+            key = (session.status, session.database_name)
+            total, blocked = counts.get(key, (0, 0))
+            counts[key] = (total + 1, blocked + (session.blocking_session_id > 0))
+        return [SessionCountRow(status, database, total, blocked) for (status, database), (total, blocked) in counts.items()]
+
+    def blocking_edges(self, max_rows):
+        edges = [BlockingEdgeRow(s.session_id, s.blocking_session_id, s.wait_time) for s in self.sessions if s.blocking_session_id > 0]
+        return sorted(edges, key=lambda row: row.wait_time, reverse=True)[:max_rows]
+
+    def high_frequency_sample(self):
+        blocked = sum(1 for s in self.sessions if s.blocking_session_id > 0)
+        return [SampleRow(float(self.rng.randint(5, 95)), len(self.sessions), blocked)]
+
+    def query_stats(self):
+        self._advance(self.plans, ('execution_count', 'total_worker_time', 'total_logical_io', 'total_elapsed_time'))
+        return self.plans
+
+    def statement_text(self, sql_handle, start, end, max_text_chars):
+        return [StatementTextRow((STATEMENT + f"-- {sql_handle.hex()[:8]}")[:max_text_chars])]
+
+    def plan_databases(self, plan_handles):
+        handles = [bytes.fromhex(value) for value in re.findall(r'<h>0x([0-9a-f]*)</h>', plan_handles)]
+        return [PlanDatabaseRow(handle, self.plan_databases[handle]) for handle in handles if handle in self.plan_databases]
+
+    def query_store_databases(self):
+        return [DatabaseNameRow(db) for db in self.databases]
+
+    def query_store_runtime_stats(self, database, last_interval_id):
+        # Every database's Query Store rolls over to a new interval every 4 reads
+        store = self.query_stores.get(database)
+        if store is None:
+            store = self.query_stores[database] = {'interval': 1000, 'reads': 0, 'current': [], 'previous': []}
+        store['reads'] += 1
+        if store['reads'] % 4 == 1:
+            store['interval'] += 1
+            store['previous'] = store['current']
+            offset = self.databases.index(database) * self.sizes['query_store_plans']
+            store['current'] = [
+                QueryStoreRow(offset + i, store['interval'], f"0x{(offset + i) // 4 + 1:016X}", f"0x{offset + i:016X}", 1, 100, 10, 200)
+                for i in range(self.sizes['query_store_plans'])
+            ]
+        self._advance(store['current'], ('execution_count', 'total_worker_time', 'total_logical_io', 'total_elapsed_time'))
+        if last_interval_id < 0:
+            return store['current']
+        return [row for row in store['previous'] + store['current'] if row.runtime_stats_interval_id >= last_interval_id]
+
+    def query_store_text(self, database, plan_id, max_text_chars):
+        return [QueryStoreTextRow((STATEMENT + f"-- plan {plan_id}")[:max_text_chars])]
+
+    def long_running(self, max_rows, max_text_chars):
+        return [LongRunningRow(51 + i, 30.0 + i, f"0x{i:016X}", f"0x{i:016X}", (STATEMENT * 8)[:max_text_chars], s.database_name)
+                for i, s in enumerate(self.sessions[:max_rows])]
+
+    def failed_jobs(self, max_rows):
+        return self.jobs[:max_rows]
+
+    def database_states(self):
+        return self.db_states
+
+    def perf_counter_values(self):
+        self.perf_counters = [row._replace(cumulative_value=row.cumulative_value + self.rng.randint(0, 5000))
+                              if row.cumulative_value is not None else row for row in self.perf_counters]
+        return self.perf_counters
+
+
+# Per-database queries ({database} formatted in) are matched on their template
+DATABASE_NAME = re.compile(r'(\[(?:[^\]]|\]\])*\])\.sys\.')
+
+HANDLERS = {
+    queries.GET_XE_POSITION: ('GET_XE_POSITION', FakeServer.xe_position),
+    queries.GET_XE_EVENTS: ('GET_XE_EVENTS', FakeServer.xe_events_after),
+    queries.GET_QUERY_STORE_DATABASES: ('GET_QUERY_STORE_DATABASES', FakeServer.query_store_databases),
+    queries.GET_QUERY_STORE_RUNTIME_STATS: ('GET_QUERY_STORE_RUNTIME_STATS', FakeServer.query_store_runtime_stats),
+    queries.GET_QUERY_STORE_TEXT: ('GET_QUERY_STORE_TEXT', FakeServer.query_store_text),
+    queries.LIVENESS_PROBE: ('LIVENESS_PROBE', lambda server: [(1,)]),
+    queries.GET_CPU_USAGE: ('GET_CPU_USAGE', FakeServer.cpu_usage),
+    queries.GET_MEMORY_USAGE: ('GET_MEMORY_USAGE', FakeServer.memory),
+    queries.GET_IO_STATS: ('GET_IO_STATS', FakeServer.io_stats),
+    queries.GET_WAIT_STATS: ('GET_WAIT_STATS', FakeServer.wait_stats),
+    queries.GET_RECENT_EXCEPTIONS: ('GET_RECENT_EXCEPTIONS', FakeServer.exceptions),
+    queries.GET_ACTIVE_SESSIONS: ('GET_ACTIVE_SESSIONS', FakeServer.active_sessions),
+    queries.GET_BLOCKING_EDGES: ('GET_BLOCKING_EDGES', FakeServer.blocking_edges),
+    queries.GET_HIGH_FREQUENCY_SAMPLE: ('GET_HIGH_FREQUENCY_SAMPLE', FakeServer.high_frequency_sample),
+    queries.GET_QUERY_STATS: ('GET_QUERY_STATS', FakeServer.query_stats),
+    queries.GET_STATEMENT_TEXT: ('GET_STATEMENT_TEXT', FakeServer.statement_text),
+    queries.GET_PLAN_DATABASES: ('GET_PLAN_DATABASES', FakeServer.plan_databases),
+    queries.GET_LONG_RUNNING_QUERIES: ('GET_LONG_RUNNING_QUERIES', FakeServer.long_running),
+    queries.GET_FAILED_JOBS: ('GET_FAILED_JOBS', FakeServer.failed_jobs),
+    queries.GET_DB_STATES: ('GET_DB_STATES', FakeServer.database_states),
+}
+# Queries written inline in the built-in metric specs, by spec name
+SPEC_HANDLERS = {
+    'perf_counters': FakeServer.perf_counter_values,
+}
+for _spec in metric_specs.load_specs(metric_specs.DEFAULT_SPECS_FILE):
+    if _spec['name'] in SPEC_HANDLERS:
+        HANDLERS[_spec['query']] = (_spec['name'], SPEC_HANDLERS[_spec['name']])
+
+# Columns of the result sets that can come back empty, for cursor.description
+RESULT_COLUMNS = {
+    'GET_MEMORY_USAGE': MemoryRow._fields,
+    'GET_ACTIVE_SESSIONS': SessionCountRow._fields,
+    'GET_FAILED_JOBS': JobRow._fields,
+    'GET_DB_STATES': DbStateRow._fields,
+    'perf_counters': PerfCounterRow._fields,
+}
+
+
+class FixtureRow:
+    def __init__(self, values):
+        self.__dict__.update(values)
+        self._values = tuple(values.values())
+
+    def __getitem__(self, index):
+        return self._values[index]
+
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = iter(())
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, sql, *params):
+        if self.connection.closed:
+            raise ProgrammingError('Attempt to use a closed connection.')
+        if sql.startswith('SET '):
+            # Session options (SET LOCK_TIMEOUT ...) return no result set
+            self.rowcount = -1
+            self.rows = iter(())
+            self.description = None
+            return self
+        handler = HANDLERS.get(sql)
+        match = DATABASE_NAME.search(sql) if handler is None else None
+        if match:
+            handler = HANDLERS.get(sql.replace(match.group(1), '{database}'))
+            params = (match.group(1)[1:-1].replace(']]', ']'),) + params
+        if handler is None:
+            raise ProgrammingError('42000', 'Fake driver has no result set for this query')
+        name, method = handler
+        fixture = _settings['fixtures'].get(name)
+        if fixture is not None:
+            rows = [FixtureRow(row) for row in fixture]
+        else:
+            rows = method(self.connection.server, *params)
+        self.rowcount = len(rows)
+        self.rows = iter(list(rows))
+        if fixture:
+            columns = list(fixture[0])
+        elif rows and hasattr(rows[0], '_fields'):
+            columns = rows[0]._fields
+        else:
+            columns = RESULT_COLUMNS.get(name, ())
+        self.description = [(column, None, None, None, None, None, True) for column in columns]
+        return self
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size=1):
+        return [row for _, row in zip(range(size), self.rows)]
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def __iter__(self):
+        return self.rows
+
+    def nextset(self):
+        # One result set per query
+        self.rows = iter(())
+        return False
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        self.rows = iter(())
+
+
+class Connection:
+    def __init__(self, server):
+        self.server = server
+        self.timeout = 0
+        self.closed = False
+
+    def cursor(self):
+        return Cursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+def connect(connection_string, timeout=0, **kwargs):
+    settings = dict(part.split('=', 1) for part in connection_string.split(';') if '=' in part)
+    name = settings.get('SERVER', 'fake')
+    server = _servers.get(name)
+    if server is None:
+        server = _servers[name] = FakeServer(name)
+    return Connection(server)
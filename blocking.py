@@ -0,0 +1,57 @@
+class BlockingChain:
+    # Everything blocked, directly or through other blocked requests, by one head blocker
+    __slots__ = ('head', 'victims', 'depth', 'wait_ms')
+
+    def __init__(self, head):
+        self.head = head
+        self.victims = 0
+        self.depth = 0
+        self.wait_ms = 0
+
+
+def blocking_chains(edges):
+    # edges: (session_id, blocking_session_id, wait_time_ms) for every blocked request.
+    # A head blocker is a session that blocks others without being blocked itself
+    # (often an idle session holding an open transaction, so it has no request row).
+    # Each session is walked once: resolved sessions remember their head and depth,
+    # so the walk is linear in the number of edges (capped by the query) even during
+    # a lock storm, and cycles are detected instead of followed.
+    # Returns the chains ordered by number of victims, largest first.
+    blocker_of = {}
+    wait_of = {}
+    for session, blocker, wait_ms in edges:
+        blocker_of[session] = blocker
+        wait_of[session] = wait_ms or 0
+
+    resolved = {}  # session -> (head, depth)
+    for session in blocker_of:
+        if session in resolved:
+            continue
+        path = []
+        on_path = set()
+        current = session
+        while current in blocker_of and current not in resolved and current not in on_path:
+            path.append(current)
+            on_path.add(current)
+            current = blocker_of[current]
+        if current in resolved:
+            head, depth = resolved[current]
+        else:
+            # A true head, or a cycle (a deadlock the monitor hasn't broken yet), in
+            # which case the session where the walk closed the loop stands in as head
+            head, depth = current, 0
+        for member in reversed(path):
+            if member == head:
+                continue
+            depth += 1
+            resolved[member] = (head, depth)
+
+    chains = {}
+    for session, (head, depth) in resolved.items():
+        chain = chains.get(head)
+        if chain is None:
+            chain = chains[head] = BlockingChain(head)
+        chain.victims += 1
+        chain.depth = max(chain.depth, depth)
+        chain.wait_ms += wait_of[session]
+    return sorted(chains.values(), key=lambda chain: (chain.victims, chain.wait_ms), reverse=True)
@@ -5,14 +5,25 @@ echo "Building SQL Server Metrics Collector..."
 pip install pyinstaller
 
 # Build the executable
-# --onefile: Create a single executable file
-# --name: Name of the output file
-# --add-data: Include default config (though we expect external config usually)
-# Note: config.yaml is tricky with onefile. 
-# Usually we want the user to provide config.yaml next to the binary.
-# The app checks for config.yaml in the current working directory, which is fine.
+# --onedir (default): a directory with the executable next to its libraries. Nothing is
+#   unpacked on start, so it starts about as fast as running from source. Pass --onefile
+#   for a single file instead, which extracts itself to a temporary directory on every start.
+# --add-data: metrics.yaml (the built-in metric specs) is bundled next to the modules
+# --exclude-module: standard library packages the exporter never imports
+# config.yaml is not bundled: the app reads it from the current working directory.
+MODE="--onedir"
+if [ "$1" = "--onefile" ]; then
+    MODE="--onefile"
+fi
 
-pyinstaller --onefile --name sql_metrics_collector main.py
+pyinstaller $MODE --noconfirm --name sql_metrics_collector \
+    --add-data "metrics.yaml:." \
+    --exclude-module tkinter --exclude-module unittest --exclude-module pydoc --exclude-module lib2to3 \
+    main.py
 
-echo "Build complete. Executable is in dist/sql_metrics_collector"
-echo "Don't forget to copy config.yaml to the same directory as the executable!"
+if [ "$MODE" = "--onefile" ]; then
+    echo "Build complete. Executable is in dist/sql_metrics_collector"
+else
+    echo "Build complete. Executable is in dist/sql_metrics_collector/ (copy the whole directory)"
+fi
+echo "Don't forget to copy config.yaml to the directory you run it from!"
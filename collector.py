@@ -1,30 +1,129 @@
 import pyodbc
 import logging
 import time
+from functools import partial
 from prometheus_client import Gauge, Info, Counter
+from deltas import CounterDeltas
+from series import SeriesTracker
+from fingerprints import QUERY_TEXTS, query_fingerprint
+import top_queries
+from blocking import blocking_chains
+from xevents import EventCounts, is_file_not_found
+from metric_specs import compile_specs, DEFAULT_SPECS_FILE
+from timestamped import TimestampedGauge
+from connections import ConnectionManager, ConnectionUnavailable, is_connection_error
+from instrumentation import (
+    EXPORTER_COLLECTOR_DURATION, EXPORTER_ROWS_FETCHED, EXPORTER_TEXT_CHARS,
+    EXPORTER_ERRORS, EXPORTER_RECONNECTS, InstrumentedCursor, error_class
+)
 from queries import (
-    GET_CPU_USAGE, GET_MEMORY_USAGE, GET_IO_STATS, GET_WAIT_STATS,
-    GET_ACTIVE_SESSIONS, GET_TOP_CPU_QUERIES, GET_TOP_IO_QUERIES, 
-    GET_LONG_RUNNING_QUERIES, GET_FAILED_JOBS, GET_DB_STATES,
-    GET_RECENT_EXCEPTIONS
+    GET_CPU_USAGE, GET_IO_STATS, GET_WAIT_STATS,
+    GET_BLOCKING_EDGES, GET_QUERY_STATS, GET_STATEMENT_TEXT, GET_PLAN_DATABASES, GET_LONG_RUNNING_QUERIES,
+    GET_RECENT_EXCEPTIONS, SET_LOCK_TIMEOUT, GET_QUERY_STORE_DATABASES,
+    GET_QUERY_STORE_RUNTIME_STATS, GET_QUERY_STORE_TEXT, GET_XE_POSITION, GET_XE_EVENTS
 )
 
 # Metrics Definitions
-SQL_UP = Gauge('sql_server_up', 'SQL Server connect success')
-SQL_CPU_UTILIZATION = Gauge('sql_cpu_utilization_percent', 'CPU Utilization', ['type']) # process, system, other
-SQL_MEMORY_KB = Gauge('sql_memory_usage_kb', 'Memory usage in KB', ['metric'])
-SQL_IO_STATS = Gauge('sql_io_stall_total_ms', 'IO Stall time in ms', ['database', 'file', 'type'])
-SQL_WAIT_STATS = Gauge('sql_wait_time_total_ms', 'Cumulative wait time in ms', ['wait_type'])
-SQL_ACTIVE_SESSIONS = Gauge('sql_active_sessions', 'Number of active sessions', ['status', 'database'])
-SQL_BLOCKING_SESSIONS = Gauge('sql_blocking_sessions', 'Number of blocking sessions')
-SQL_DB_STATE = Gauge('sql_database_state', 'Database state (1=Online)', ['database', 'state_desc'])
-SQL_FAILED_JOBS = Gauge('sql_failed_jobs_today', 'Count of failed jobs today', ['job_name'])
-SQL_ERROR_LOG_COUNT = Gauge('sql_error_log_recent_count', 'Count of recent severe errors')
+SQL_UP = Gauge('sql_server_up', 'SQL Server connect success', ['instance'])
+SQL_CPU_UTILIZATION = Gauge('sql_cpu_utilization_percent', 'CPU Utilization', ['instance', 'type']) # process, system, other
+SQL_IO_STATS = Gauge('sql_io_stall_total_ms', 'IO Stall time in ms', ['instance', 'database', 'file', 'type'])
+SQL_WAIT_STATS = Gauge('sql_wait_time_total_ms', 'Cumulative wait time in ms', ['instance', 'wait_type'])
+# Blocking chains, one series set per head blocker (the session at the top of a chain)
+SQL_BLOCKING_CHAINS = Gauge('sql_blocking_chains', 'Head blockers currently blocking other requests', ['instance'])
+SQL_BLOCKING_CHAIN_VICTIMS = Gauge('sql_blocking_chain_victims', 'Requests blocked directly or indirectly by a head blocker', ['instance', 'head_session_id'])
+SQL_BLOCKING_CHAIN_DEPTH = Gauge('sql_blocking_chain_depth', 'Longest chain of waiting requests under a head blocker', ['instance', 'head_session_id'])
+SQL_BLOCKING_CHAIN_WAIT = Gauge('sql_blocking_chain_wait_seconds', 'Current wait time summed over the requests under a head blocker', ['instance', 'head_session_id'])
+SQL_ERROR_LOG_COUNT = Gauge('sql_error_log_recent_count', 'Exceptions recorded in the ring buffer since the previous refresh', ['instance'])
+SQL_EXCEPTIONS = Counter('sql_ring_buffer_exceptions', 'Exceptions recorded in the exception ring buffer', ['instance'])
+SQL_DEADLOCKS = Counter('sql_deadlocks', 'Deadlocks reported by Extended Events', ['instance'])
+SQL_LOCK_TIMEOUTS = Counter('sql_lock_timeouts', 'Lock requests that timed out, reported by Extended Events', ['instance'])
+SQL_ERRORS_REPORTED = Counter('sql_errors_reported', 'Errors reported by Extended Events', ['instance', 'error_number', 'severity'])
+# Every per-minute scheduler monitor record, timestamped with when SQL Server took it,
+# so minutes missed while the exporter couldn't reach the server are filled in
+SQL_CPU_HISTORY = TimestampedGauge('sql_cpu_utilization_history_percent', 'CPU Utilization per ring buffer record', ['instance', 'type'])
 
 # New Metrics for Query Performance
-SQL_TOP_QUERY_CPU = Gauge('sql_top_query_cpu_ms', 'Top Queries by CPU', ['query_text_short', 'database'])
-SQL_TOP_QUERY_IO = Gauge('sql_top_query_io_ops', 'Top Queries by I/O', ['query_text_short', 'database'])
-SQL_LONG_RUNNING_QUERY = Gauge('sql_long_running_query_duration_seconds', 'Long Running Queries', ['session_id', 'query_text_short', 'database'])
+# Queries are identified by a 16 hex digit fingerprint (their query_hash); the
+# normalized statement text is served by the /queries endpoint.
+# Top queries are ranked by what they consumed during the last refresh interval, not lifetime totals.
+SQL_TOP_QUERY_CPU = Gauge('sql_top_query_cpu_ms', 'Top Queries by CPU time used in the last interval', ['instance', 'query_hash', 'database'])
+SQL_TOP_QUERY_IO = Gauge('sql_top_query_io_ops', 'Top Queries by logical reads + writes in the last interval', ['instance', 'query_hash', 'database'])
+SQL_TOP_QUERY_DURATION = Gauge('sql_top_query_duration_ms', 'Top Queries by elapsed time in the last interval', ['instance', 'query_hash', 'database'])
+SQL_TOP_QUERY_EXECUTIONS = Gauge('sql_top_query_executions', 'Top Queries by executions in the last interval', ['instance', 'query_hash', 'database'])
+SQL_LONG_RUNNING_QUERY = Gauge('sql_long_running_query_duration_seconds', 'Long Running Queries', ['instance', 'session_id', 'query_hash', 'database'])
+
+# Per-interval values derived from the cumulative DMV counters above
+SQL_IO_READ_LATENCY = Gauge('sql_io_read_latency_ms', 'Average read latency per file over the last interval', ['instance', 'database', 'file'])
+SQL_IO_WRITE_LATENCY = Gauge('sql_io_write_latency_ms', 'Average write latency per file over the last interval', ['instance', 'database', 'file'])
+SQL_IO_BYTES_RATE = Gauge('sql_io_bytes_per_second', 'File throughput over the last interval', ['instance', 'database', 'file', 'direction'])
+SQL_IO_OPS_RATE = Gauge('sql_io_ops_per_second', 'File I/O operations per second over the last interval', ['instance', 'database', 'file', 'direction'])
+SQL_WAIT_INTERVAL = Gauge('sql_wait_time_interval_ms', 'Wait time accrued during the last interval', ['instance', 'wait_type'])
+SQL_WAIT_TASKS_INTERVAL = Gauge('sql_wait_tasks_interval', 'Waits started during the last interval', ['instance', 'wait_type'])
+SQL_WAIT_SPLIT_RATE = Gauge('sql_wait_time_ms_per_second', 'Wait time per second over the last interval, split into signal (CPU) and resource waits', ['instance', 'kind'])
+SQL_COUNTER_RESETS = Counter('sql_counter_resets', 'Cumulative DMV counter resets detected (restart, DBCC SQLPERF CLEAR)', ['instance', 'source'])
+
+# Everything above; in pull mode these (and the metric spec ones, metric_specs.SPEC_METRICS)
+# are exported through scrape.OnDemandCollector
+SQL_METRICS = (
+    SQL_UP, SQL_CPU_UTILIZATION, SQL_IO_STATS, SQL_WAIT_STATS,
+    SQL_BLOCKING_CHAINS, SQL_BLOCKING_CHAIN_VICTIMS,
+    SQL_BLOCKING_CHAIN_DEPTH, SQL_BLOCKING_CHAIN_WAIT, SQL_ERROR_LOG_COUNT,
+    SQL_EXCEPTIONS, SQL_DEADLOCKS, SQL_LOCK_TIMEOUTS, SQL_ERRORS_REPORTED, SQL_CPU_HISTORY,
+    SQL_TOP_QUERY_CPU, SQL_TOP_QUERY_IO, SQL_TOP_QUERY_DURATION, SQL_TOP_QUERY_EXECUTIONS, SQL_LONG_RUNNING_QUERY,
+    SQL_IO_READ_LATENCY, SQL_IO_WRITE_LATENCY, SQL_IO_BYTES_RATE, SQL_IO_OPS_RATE,
+    SQL_WAIT_INTERVAL, SQL_WAIT_TASKS_INTERVAL, SQL_WAIT_SPLIT_RATE, SQL_COUNTER_RESETS,
+)
+
+# (metric, QueryStatsTracker field, scale); worker and elapsed times are in microseconds
+TOP_QUERY_RANKINGS = (
+    (SQL_TOP_QUERY_CPU, top_queries.CPU, 0.001),
+    (SQL_TOP_QUERY_IO, top_queries.IO, 1),
+    (SQL_TOP_QUERY_DURATION, top_queries.DURATION, 0.001),
+    (SQL_TOP_QUERY_EXECUTIONS, top_queries.EXECUTIONS, 1),
+)
+# Plan handles per database lookup of newly active statements
+PLAN_DATABASE_BATCH = 500
+
+# Refresh tiers. Expensive or slow-changing DMVs are refreshed less often;
+# between refreshes their gauges keep serving the last collected values.
+# 'fast' defaults to collection_interval_seconds. Metric spec collectors
+# (metrics.yaml) carry their own tier.
+DEFAULT_TIER_INTERVALS = {'medium': 60, 'slow': 300}
+DEFAULT_COLLECTOR_TIERS = {
+    'cpu': 'fast',
+    'waits': 'fast',
+    'blocking': 'fast',
+    'long_running_queries': 'fast',
+    'io': 'medium',
+    'errors': 'medium',
+    'xevents': 'medium',
+    'top_queries': 'medium',
+}
+# Cycles can start slightly early (sleep jitter); don't push a collector to the next cycle for that.
+SCHEDULE_SLACK = 0.05
+
+# Most rows a collector asks the server for ('row_limits' in the config overrides these)
+DEFAULT_ROW_LIMITS = {
+    'io': 5000,
+    'waits': 2000,
+    'blocking': 5000,
+    'long_running_queries': 10,
+    'xevents': 1000,
+}
+
+
+def iter_rows(cursor, batch_size):
+    # Streams a result set in fetchmany() batches so only one batch of rows is held at a time
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def quote_name(name):
+    # T-SQL QUOTENAME for database names formatted into a query
+    return '[' + name.replace(']', ']]') + ']'
 
 
 class MetricsCollector:
@@ -39,214 +138,591 @@ class MetricsCollector:
             f"Encrypt={config.get('encrypt', 'yes')};"
             f"TrustServerCertificate={config.get('trust_server_certificate', 'yes')};"
         )
-        self.conn = None
-        self.logger = logging.getLogger("MetricsCollector")
+        # Value of the 'instance' label on every metric this collector exports
+        self.instance = config.get('name') or config['server']
+        self.logger = logging.getLogger(f"MetricsCollector[{self.instance}]")
+
+        # Collectors in execution order; each runs on its own refresh interval
+        self.collectors = [
+            ('cpu', self._collect_cpu),
+            ('io', self._collect_io),
+            ('waits', self._collect_waits),
+            ('blocking', self._collect_blocking),
+            ('errors', self._collect_errors),
+            ('xevents', self._collect_xevents),
+            ('top_queries', self._collect_top_queries),
+            ('long_running_queries', self._collect_long_running_queries),
+        ]
+        # Declarative collectors (memory, sessions, db_states, jobs, perf_counters, and
+        # any under 'metrics' in the config), compiled once for this target
+        self.specs = compile_specs(self.instance, config.get('metric_specs_file', DEFAULT_SPECS_FILE), config.get('metrics'))
+        for spec in self.specs:
+            self.collectors.append((spec.name, partial(self._collect_spec, spec)))
+        self.intervals = self._resolve_intervals()
+        self.batch_size = config.get('fetch_batch_size', 500)
+        self.max_text_chars = config.get('query_text_max_chars', 4000)
+        self.row_limits = dict(DEFAULT_ROW_LIMITS)
+        self.row_limits.update(config.get('row_limits') or {})
+        self.last_run = {}
+
+        # Previous samples of cumulative counters, diffed on every refresh
+        self.io_deltas = CounterDeltas((
+            'num_of_reads', 'num_of_bytes_read', 'io_stall_read_ms',
+            'num_of_writes', 'num_of_bytes_written', 'io_stall_write_ms'
+        ))
+        self.wait_deltas = CounterDeltas(('waiting_tasks_count', 'wait_time_ms', 'signal_wait_time_ms'))
+        self.query_stats = top_queries.QueryStatsTracker()
+
+        # Ring buffer timestamp (ms_ticks) of the newest record already processed
+        self.cpu_watermark = 0
+        self.exception_watermark = 0
+        # (file_name, file_offset) of the last Extended Events buffer read; None until
+        # the end of the session's files has been found
+        self.xe_session = config.get('xe_session', 'system_health')
+        self.xe_position = None
+        self.xe_lock_timeout_errors = True
+
+        # Logs in on a background thread with backoff; every connection the collector
+        # opens (async pools, sampler) goes through it. In async mode its own
+        # connection is never opened: the engine's pool replaces it.
+        self.connections = ConnectionManager(
+            self._open_connection,
+            self.instance,
+            backoff_initial=config.get('reconnect_backoff_initial_seconds', 1),
+            backoff_max=config.get('reconnect_backoff_max_seconds', 300),
+            probe_interval=config.get('connection_probe_interval_seconds', 60),
+            query_timeout=config.get('query_timeout_seconds', 0),
+            query_timeouts=config.get('collector_query_timeouts'),
+            on_login_error=lambda e: self._record_error('connect', e),
+            on_reconnect=self._count_reconnect
+        )
+
+        # 'async' runs the due collectors concurrently over a small connection pool
+        self.engine = None
+        if config.get('collection_engine', 'serial') == 'async':
+            # asyncio is only imported when an async engine is configured
+            from async_engine import AsyncQueryEngine
+            self.engine = AsyncQueryEngine(
+                self.connections.open,
+                max_connections=config.get('max_connections_per_target', 3),
+                query_timeout=config.get('collector_timeout_seconds', 10),
+                name=self.instance,
+                cursor_timeout=self.connections.timeout_for,
+                on_login_error=lambda e: self._record_error('connect', e),
+                on_reconnect=self._count_reconnect
+            )
+
+        # 'query_store' ranks top queries from each database's Query Store instead of the
+        # plan cache. Databases are read in parallel over their own small connection pool,
+        # each from the runtime_stats_interval_id it reached last time.
+        self.query_store = None
+        self.query_store_watermarks = {}
+        if config.get('top_queries_source', 'plan_cache') == 'query_store':
+            from async_engine import AsyncQueryEngine
+            self.query_store = AsyncQueryEngine(
+                self.connections.open,
+                max_connections=config.get('query_store_max_parallel_databases', 8),
+                query_timeout=config.get('collector_timeout_seconds', 10),
+                name=f"{self.instance}-query-store",
+                cursor_timeout=lambda _: self.connections.timeout_for('top_queries'),
+                on_login_error=lambda e: self._record_error('connect', e),
+                on_reconnect=self._count_reconnect
+            )
+
+        # Optional sub-scrape sampling of cheap DMVs on a separate thread and connection
+        self.sampler = None
+        if config.get('sampling_interval_seconds'):
+            from sampling import Sampler
+            self.sampler = Sampler(
+                self.connections.open,
+                self.instance,
+                interval=config['sampling_interval_seconds'],
+                capacity=config.get('sampling_buffer_size', 600),
+                window=config.get('sampling_window_seconds', 30)
+            )
+            self.sampler.start()
+
+        # Label sets each collector exported on its last refresh; the ones that
+        # disappear (finished sessions, evicted plans, dropped databases) are removed
+        self.series = {
+            'io': SeriesTracker(SQL_IO_STATS, SQL_IO_READ_LATENCY, SQL_IO_WRITE_LATENCY, SQL_IO_BYTES_RATE, SQL_IO_OPS_RATE),
+            'waits': SeriesTracker(SQL_WAIT_STATS, SQL_WAIT_INTERVAL, SQL_WAIT_TASKS_INTERVAL),
+            'blocking': SeriesTracker(SQL_BLOCKING_CHAIN_VICTIMS, SQL_BLOCKING_CHAIN_DEPTH, SQL_BLOCKING_CHAIN_WAIT),
+            'top_queries': SeriesTracker(SQL_TOP_QUERY_CPU, SQL_TOP_QUERY_IO, SQL_TOP_QUERY_DURATION, SQL_TOP_QUERY_EXECUTIONS),
+            'long_running_queries': SeriesTracker(SQL_LONG_RUNNING_QUERY),
+        }
+
+    def _resolve_intervals(self):
+        base = self.config.get('collection_interval_seconds', 15)
+        tiers = {'fast': base}
+        tiers.update(DEFAULT_TIER_INTERVALS)
+        tiers.update(self.config.get('tier_intervals_seconds') or {})
+
+        # 'collector_tiers' maps a collector to a tier name or a number of seconds
+        assignments = dict(DEFAULT_COLLECTOR_TIERS)
+        assignments.update({spec.name: spec.tier for spec in self.specs})
+        assignments.update(self.config.get('collector_tiers') or {})
+
+        intervals = {}
+        for name, _ in self.collectors:
+            tier = assignments.get(name, 'fast')
+            if isinstance(tier, (int, float)):
+                interval = tier
+            elif tier in tiers:
+                interval = tiers[tier]
+            else:
+                self.logger.warning(f"Unknown tier '{tier}' for collector '{name}', using 'fast'")
+                interval = base
+            # Nothing can run more often than the collection loop ticks
+            intervals[name] = max(interval, base)
+        return intervals
+
+    def due_collectors(self, now):
+        due = []
+        for name, method in self.collectors:
+            last = self.last_run.get(name)
+            if last is None or now - last >= self.intervals[name] * (1 - SCHEDULE_SLACK):
+                due.append((name, method))
+        return due
+
+    def _open_connection(self):
+        conn = pyodbc.connect(self.connection_string, timeout=self.config.get('login_timeout_seconds', 10))
+        # Query timeout (0 = wait forever) so a hung server releases the worker thread
+        conn.timeout = self.config.get('query_timeout_seconds', 0)
+        lock_timeout_ms = self.config.get('lock_timeout_ms', 5000)
+        if lock_timeout_ms is not None:
+            cursor = conn.cursor()
+            cursor.execute(SET_LOCK_TIMEOUT.format(lock_timeout_ms=int(lock_timeout_ms)))
+            cursor.close()
+        return conn
+
+    def _count_reconnect(self):
+        EXPORTER_RECONNECTS.labels(self.instance).inc()
 
     def connect(self):
-        try:
-            self.logger.info("Attempting to connect to SQL Server...")
-            self.conn = pyodbc.connect(self.connection_string, timeout=10)
-            SQL_UP.set(1)
-            self.logger.info("Connected to SQL Server")
-        except Exception as e:
-            SQL_UP.set(0)
-            self.logger.error(f"Failed to connect to SQL Server: {e}")
-            self.conn = None
+        # Starts logging in without waiting for it; collect() uses the connection once it is up
+        if self.engine is not None:
+            self.engine.prepare(self.config.get('max_connections_per_target', 3))
+        else:
+            self.connections.start()
 
     def collect(self):
-        if not self.conn:
-            self.connect()
-        
-        if not self.conn:
+        now = time.monotonic()
+        due = self.due_collectors(now)
+        if not due:
             return
 
-        cursor = None
-        try:
-            cursor = self.conn.cursor()
-            self._collect_cpu(cursor)
-            self._collect_memory(cursor)
-            self._collect_io(cursor)
-            self._collect_waits(cursor)
-            self._collect_sessions(cursor)
-            self._collect_db_states(cursor)
-            self._collect_jobs(cursor)
-            self._collect_errors(cursor)
-            
-            # New Metrics
-            self._collect_top_cpu_queries(cursor)
-            self._collect_top_io_queries(cursor)
-            self._collect_long_running_queries(cursor)
-            
-        except pyodbc.Error as e:
-            self.logger.error(f"Error during collection (Connection Lost?): {e}")
-            SQL_UP.set(0)
-            # Force close and reset connection
+        if self.engine is not None:
+            self._collect_concurrently([(name, partial(self._run_collector, name, method)) for name, method in due], now)
+            return
+
+        # Never waits for a login: while the server is unreachable the cycle is skipped
+        # and the connection manager keeps retrying in the background
+        if self.connections.get() is None:
+            SQL_UP.labels(instance=self.instance).set(0)
+            return
+        SQL_UP.labels(instance=self.instance).set(1)
+
+        for name, method in due:
             try:
-                if cursor: cursor.close()
-                if self.conn: self.conn.close()
-            except:
-                pass
-            self.conn = None
-            self.logger.info("Connection reset. Will attempt reconnect on next cycle.")
+                self._run_collector(name, method, self.connections.cursor(name))
+                self.last_run[name] = now
+            except pyodbc.Error as e:
+                # Collectors handle their own query errors; this is the cursor failing
+                self._record_error(name, e)
+                self.logger.error(f"Error during collection of '{name}': {e}")
+            if self.connections.conn is None:
+                # A connection-level error: the rest of the cycle would fail the same way
+                SQL_UP.labels(instance=self.instance).set(0)
+                break
+
+    def _run_collector(self, name, method, cursor):
+        instrumented = InstrumentedCursor(cursor)
+        start = time.perf_counter()
+        try:
+            method(instrumented)
         finally:
-            if cursor:
-                try: cursor.close()
-                except: pass
+            EXPORTER_COLLECTOR_DURATION.labels(self.instance, name).observe(time.perf_counter() - start)
+            EXPORTER_ROWS_FETCHED.labels(self.instance, name).inc(instrumented.rows)
+        error = instrumented.error
+        if self.engine is not None and isinstance(error, pyodbc.Error) and is_connection_error(error):
+            # The collector has recorded the failure; raising makes the engine discard
+            # the pooled connection instead of handing it to the next collector
+            raise ConnectionUnavailable(f"Connection lost: {error}")
 
-    def _collect_cpu(self, cursor):
+    def _record_error(self, collector, error):
+        EXPORTER_ERRORS.labels(self.instance, collector, error_class(error)).inc()
+        # A query error only fails its collector; a lost connection is reopened in the background
+        if self.engine is None and collector != 'connect' and is_connection_error(error):
+            self.connections.invalidate()
+
+    def _collect_concurrently(self, due, now):
+        results = self.engine.run(due)
+        for name, status in results.items():
+            # A collector that timed out waits for its next interval rather than hammering a struggling server
+            if status in ('ok', 'timeout'):
+                self.last_run[name] = now
+        # Down while the pool has no connection or when every collector lost its connection
+        statuses = set(results.values())
+        if 'ok' in statuses:
+            SQL_UP.labels(instance=self.instance).set(1)
+        elif statuses <= {'error', 'connecting'}:
+            SQL_UP.labels(instance=self.instance).set(0)
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.engine is not None:
+            self.engine.close()
+        if self.query_store is not None:
+            self.query_store.close()
+        self.connections.close()
+
+    def _collect_spec(self, spec, cursor):
+        if spec.toggle and not self.config.get(spec.toggle, True):
+            return
         try:
-            cursor.execute(GET_CPU_USAGE)
-            row = cursor.fetchone()
-            if row:
-                SQL_CPU_UTILIZATION.labels(type='sql_process').set(row.SQLProcessUtilization)
-                SQL_CPU_UTILIZATION.labels(type='system_idle').set(row.SystemIdle)
-                SQL_CPU_UTILIZATION.labels(type='other_process').set(row.OtherProcessUtilization)
+            spec.collect(cursor, lambda cursor: iter_rows(cursor, self.batch_size), self.row_limits.get(spec.name))
         except Exception as e:
-            self.logger.warning(f"Failed to collect CPU: {e}")
+            self._record_error(spec.name, e)
+            self.logger.warning(f"Failed to collect '{spec.name}': {e}")
 
-    def _collect_memory(self, cursor):
+    def _collect_cpu(self, cursor):
         try:
-            cursor.execute(GET_MEMORY_USAGE)
-            row = cursor.fetchone()
-            if row:
-                SQL_MEMORY_KB.labels(metric='physical_memory_in_use_kb').set(row.physical_memory_in_use_kb)
-                SQL_MEMORY_KB.labels(metric='large_page_allocations_kb').set(row.large_page_allocations_kb)
-                SQL_MEMORY_KB.labels(metric='page_fault_count').set(row.page_fault_count)
+            # The scheduler monitor writes one record per minute, so most refreshes
+            # return nothing and the gauges keep the latest minute
+            max_age_ms = self.config.get('cpu_history_max_minutes', 60) * 60000
+            cursor.execute(GET_CPU_USAGE, self.cpu_watermark, max_age_ms)
+            rows = cursor.fetchall()
+            now = time.time()
+            for row in rows:
+                measured_at = now - row.age_ms / 1000.0
+                SQL_CPU_HISTORY.add((self.instance, 'sql_process'), measured_at, row.SQLProcessUtilization)
+                SQL_CPU_HISTORY.add((self.instance, 'system_idle'), measured_at, row.SystemIdle)
+                SQL_CPU_HISTORY.add((self.instance, 'other_process'), measured_at, row.OtherProcessUtilization)
+            if rows:
+                row = rows[-1]
+                self.cpu_watermark = row.timestamp
+                SQL_CPU_UTILIZATION.labels(instance=self.instance, type='sql_process').set(row.SQLProcessUtilization)
+                SQL_CPU_UTILIZATION.labels(instance=self.instance, type='system_idle').set(row.SystemIdle)
+                SQL_CPU_UTILIZATION.labels(instance=self.instance, type='other_process').set(row.OtherProcessUtilization)
         except Exception as e:
-            self.logger.warning(f"Failed to collect Memory: {e}")
+            self._record_error('cpu', e)
+            self.logger.warning(f"Failed to collect CPU: {e}")
 
     def _collect_io(self, cursor):
         try:
-            cursor.execute(GET_IO_STATS)
-            rows = cursor.fetchall()
-            for row in rows:
-                # Row: db_name, logical_name, type, num_reads, bytes_read, stall_read, ...
+            cursor.execute(GET_IO_STATS, self.row_limits['io'])
+            now = time.monotonic()
+            resets = self.io_deltas.resets
+            series = self.series['io']
+            series.begin()
+            for row in iter_rows(cursor, self.batch_size):
+                # Row: db_name, logical_name, num_reads, bytes_read, stall_read, ...
                 # Using stall times as primary metric for performance
-                SQL_IO_STATS.labels(database=row.database_name, file=row.logical_name, type='read').set(row.io_stall_read_ms)
-                SQL_IO_STATS.labels(database=row.database_name, file=row.logical_name, type='write').set(row.io_stall_write_ms)
+                series.labels(SQL_IO_STATS, self.instance, row.database_name, row.logical_name, 'read').set(row.io_stall_read_ms)
+                series.labels(SQL_IO_STATS, self.instance, row.database_name, row.logical_name, 'write').set(row.io_stall_write_ms)
+
+                sample = self.io_deltas.update(
+                    (row.database_name, row.logical_name),
+                    (row.num_of_reads, row.num_of_bytes_read, row.io_stall_read_ms,
+                     row.num_of_writes, row.num_of_bytes_written, row.io_stall_write_ms),
+                    now
+                )
+                if sample is None:
+                    continue  # First sample of this file, nothing to diff against yet
+                (reads, bytes_read, stall_read, writes, bytes_written, stall_write), elapsed = sample
+                self._export_io_deltas(series, row.database_name, row.logical_name,
+                                       reads, bytes_read, stall_read, writes, bytes_written, stall_write, elapsed)
+            self.io_deltas.sweep()
+            series.sweep()
+            if self.io_deltas.resets > resets:
+                SQL_COUNTER_RESETS.labels(instance=self.instance, source='io').inc(self.io_deltas.resets - resets)
         except Exception as e:
+            self._record_error('io', e)
             self.logger.warning(f"Failed to collect IO: {e}")
 
     def _collect_waits(self, cursor):
         try:
-            cursor.execute(GET_WAIT_STATS)
-            rows = cursor.fetchall()
-            for row in rows:
-                SQL_WAIT_STATS.labels(wait_type=row.wait_type).set(row.wait_time_ms)
-        except Exception as e:
-            self.logger.warning(f"Failed to collect WAITS: {e}")
+            cursor.execute(GET_WAIT_STATS, self.row_limits['waits'])
+            now = time.monotonic()
+            resets = self.wait_deltas.resets
+            signal_ms = 0.0
+            resource_ms = 0.0
+            interval = None
+            series = self.series['waits']
+            series.begin()
+            for row in iter_rows(cursor, self.batch_size):
+                series.labels(SQL_WAIT_STATS, self.instance, row.wait_type).set(row.wait_time_ms)
 
-    def _collect_sessions(self, cursor):
-        try:
-            cursor.execute(GET_ACTIVE_SESSIONS)
-            rows = cursor.fetchall()
-            
-            # Reset blocking count
-            SQL_BLOCKING_SESSIONS.set(0)
-            
-            # Aggregate sessions by status/db for Prometheus cardinality safety
-            session_counts = {}
-            blocking_count = 0
-            
-            for row in rows:
-                key = (row.status, row.database_name or 'Unknown')
-                session_counts[key] = session_counts.get(key, 0) + 1
-                
-                if row.blocking_session_id and row.blocking_session_id > 0:
-                    blocking_count += 1
-            
-            for (status, db), count in session_counts.items():
-                SQL_ACTIVE_SESSIONS.labels(status=status, database=db).set(count)
-                
-            SQL_BLOCKING_SESSIONS.set(blocking_count)
-            
-        except Exception as e:
-            self.logger.warning(f"Failed to collect Sessions: {e}")
+                sample = self.wait_deltas.update(
+                    row.wait_type,
+                    (row.waiting_tasks_count, row.wait_time_ms, row.signal_wait_time_ms),
+                    now
+                )
+                if sample is None:
+                    continue
+                (tasks, wait_ms, signal), elapsed = sample
+                series.labels(SQL_WAIT_INTERVAL, self.instance, row.wait_type).set(wait_ms)
+                series.labels(SQL_WAIT_TASKS_INTERVAL, self.instance, row.wait_type).set(tasks)
+                # wait_time_ms includes the signal wait (time spent waiting for a CPU after being signalled)
+                signal_ms += signal
+                resource_ms += max(wait_ms - signal, 0)
+                interval = elapsed
+            self.wait_deltas.sweep()
+            series.sweep()
+            if self.wait_deltas.resets > resets:
+                SQL_COUNTER_RESETS.labels(instance=self.instance, source='waits').inc(self.wait_deltas.resets - resets)
 
-    def _collect_db_states(self, cursor):
-        try:
-            cursor.execute(GET_DB_STATES)
-            rows = cursor.fetchall()
-            for row in rows:
-                is_online = 1 if row.state_desc == 'ONLINE' else 0
-                SQL_DB_STATE.labels(database=row.name, state_desc=row.state_desc).set(is_online)
+            if interval:
+                SQL_WAIT_SPLIT_RATE.labels(instance=self.instance, kind='signal').set(signal_ms / interval)
+                SQL_WAIT_SPLIT_RATE.labels(instance=self.instance, kind='resource').set(resource_ms / interval)
         except Exception as e:
-            self.logger.warning(f"Failed to collect DB States: {e}")
+            self._record_error('waits', e)
+            self.logger.warning(f"Failed to collect WAITS: {e}")
 
-    def _collect_jobs(self, cursor):
-        if not self.config.get('detect_jobs', True):
+    def _export_io_deltas(self, series, database, file, reads, bytes_read, stall_read, writes, bytes_written, stall_write, elapsed):
+        # Average latency = stall accrued / operations completed in the interval.
+        # An idle file reports 0 rather than keeping a stale latency.
+        series.labels(SQL_IO_READ_LATENCY, self.instance, database, file).set(stall_read / reads if reads else 0)
+        series.labels(SQL_IO_WRITE_LATENCY, self.instance, database, file).set(stall_write / writes if writes else 0)
+        if elapsed <= 0:
+            return
+        series.labels(SQL_IO_BYTES_RATE, self.instance, database, file, 'read').set(bytes_read / elapsed)
+        series.labels(SQL_IO_BYTES_RATE, self.instance, database, file, 'write').set(bytes_written / elapsed)
+        series.labels(SQL_IO_OPS_RATE, self.instance, database, file, 'read').set(reads / elapsed)
+        series.labels(SQL_IO_OPS_RATE, self.instance, database, file, 'write').set(writes / elapsed)
+
+    def _collect_blocking(self, cursor):
+        if not self.config.get('detect_locks', True):
             return
         try:
-            cursor.execute(GET_FAILED_JOBS)
-            rows = cursor.fetchall()
-            
-            # This is tricky because job failures are events. 
-            # We want to show which jobs failed today.
-            # We will just expose a gauge of failed jobs count by name.
-            # If the job fixed itself, it won't appear? 
-            # The query gets failed jobs for today. 
-            
-            current_failed_jobs = set()
-            for row in rows:
-                SQL_FAILED_JOBS.labels(job_name=row.job_name).set(1)
-                current_failed_jobs.add(row.job_name)
-                
-            # Note: We aren't clearing old labels here easily without tracking them.
-            # In a real exporter we might track 'seen' jobs and set others to 0.
-            # For simplicity, we just set 1.
-            
+            cursor.execute(GET_BLOCKING_EDGES, self.row_limits['blocking'])
+            chains = blocking_chains(
+                (row.session_id, row.blocking_session_id, row.wait_time)
+                for row in iter_rows(cursor, self.batch_size)
+            )
+            SQL_BLOCKING_CHAINS.labels(instance=self.instance).set(len(chains))
+
+            # Only the largest chains get per-head series; the rest still count in sql_blocking_chains
+            series = self.series['blocking']
+            series.begin()
+            for chain in chains[:self.config.get('blocking_chains_limit', 10)]:
+                series.labels(SQL_BLOCKING_CHAIN_VICTIMS, self.instance, chain.head).set(chain.victims)
+                series.labels(SQL_BLOCKING_CHAIN_DEPTH, self.instance, chain.head).set(chain.depth)
+                series.labels(SQL_BLOCKING_CHAIN_WAIT, self.instance, chain.head).set(chain.wait_ms / 1000.0)
+            series.sweep()
         except Exception as e:
-            # Table msdb.dbo.sysjobs might not be accessible if no permissions
-            self.logger.debug(f"Failed to collect Jobs (might be permission): {e}")
+            self._record_error('blocking', e)
+            self.logger.warning(f"Failed to collect Blocking Chains: {e}")
 
     def _collect_errors(self, cursor):
-        # Only simple count
+        # Only simple count of the exceptions recorded since the previous refresh.
+        # The first read looks back one refresh interval so startup doesn't report the whole buffer.
         try:
-            cursor.execute(GET_RECENT_EXCEPTIONS)
-            rows = cursor.fetchall()
-            count = len(rows)
-            SQL_ERROR_LOG_COUNT.set(count)
+            if self.exception_watermark:
+                max_age_ms = 2**62
+            else:
+                max_age_ms = int(self.intervals['errors'] * 1000)
+            cursor.execute(GET_RECENT_EXCEPTIONS, self.exception_watermark, max_age_ms)
+            count = 0
+            for row in iter_rows(cursor, self.batch_size):
+                count += 1
+                self.exception_watermark = row.timestamp
+            SQL_ERROR_LOG_COUNT.labels(instance=self.instance).set(count)
+            SQL_EXCEPTIONS.labels(instance=self.instance).inc(count)
         except Exception as e:
+            self._record_error('errors', e)
             self.logger.debug(f"Failed to collect Errors: {e}")
 
-    def _collect_top_cpu_queries(self, cursor):
+    def _collect_xevents(self, cursor):
+        # Deadlocks, lock timeouts and errors from the XE session's event files.
+        # Each read continues after the last buffer read, so the cost follows the
+        # number of new events rather than the size of the files.
+        if not self.xe_session:
+            return
         try:
-            cursor.execute(GET_TOP_CPU_QUERIES)
-            rows = cursor.fetchall()
-            # We clean the previous metric values?? Prometheus Gauges stick.
-            # Ideally we'd timestamp or use summary. But for gauge default behavior,
-            # this works "ok" if we assume Top 10 changes often or we just show snapshots.
-            # Warning: This creates high cardinality if many unique queries appeared.
-            # Solution: We should clear? or Use truncated text.
-            # For now, we rely on Prometheus to handle it, but in long run might need clearing.
-            
-            # Since we can't easily "clear" without knowing labelset, we just set.
-            for row in rows:
-                text_short = (row.query_text or "")[:500].replace('\n', ' ').strip()
-                SQL_TOP_QUERY_CPU.labels(query_text_short=text_short, database=row.database_name).set(row.avg_cpu_ms)
+            if self.xe_position is None:
+                cursor.execute(GET_XE_POSITION, self.xe_session)
+                row = cursor.fetchone()
+                if row is None:
+                    self.logger.debug(f"No event_file target found for XE session '{self.xe_session}'")
+                    return
+                self.xe_position = (row.file_name, row.file_offset)
+                self.xe_lock_timeout_errors = not row.has_lock_timeout_events
+                return
+
+            limit = self.row_limits['xevents']
+            cursor.execute(GET_XE_EVENTS, self.xe_session, self.xe_position[0], self.xe_position[1], limit)
+            # Events are counted a buffer at a time. A result cut short by the row limit
+            # can end partway through one; that buffer is read again next time (unless
+            # it is the only one, i.e. the limit is smaller than a buffer).
+            counts = EventCounts(self.xe_lock_timeout_errors)
+            block, block_position = EventCounts(self.xe_lock_timeout_errors), None
+            position = self.xe_position
+            rows = 0
+            for row in iter_rows(cursor, self.batch_size):
+                rows += 1
+                if (row.file_name, row.file_offset) != block_position:
+                    if block_position is not None:
+                        counts.merge(block)
+                        position = block_position
+                    block, block_position = EventCounts(self.xe_lock_timeout_errors), (row.file_name, row.file_offset)
+                block.add(row.object_name, row.event_data)
+            if block_position is not None and (rows < limit or position == self.xe_position):
+                counts.merge(block)
+                position = block_position
+            self.xe_position = position
+
+            SQL_DEADLOCKS.labels(instance=self.instance).inc(counts.deadlocks)
+            SQL_LOCK_TIMEOUTS.labels(instance=self.instance).inc(counts.lock_timeouts)
+            for (error_number, severity), count in counts.errors.items():
+                SQL_ERRORS_REPORTED.labels(self.instance, error_number, severity).inc(count)
         except Exception as e:
-            self.logger.warning(f"Failed to collect Top CPU Queries: {e}")
+            self._record_error('xevents', e)
+            self.logger.warning(f"Failed to collect Extended Events: {e}")
+            # The file read last was deleted after a rollover: start again from the end.
+            # Any other error (timeouts, locks, a lost connection) keeps the position and
+            # the same buffers are retried next time.
+            if isinstance(e, pyodbc.Error) and is_file_not_found(e):
+                self.xe_position = None
 
-    def _collect_top_io_queries(self, cursor):
+    def _collect_top_queries(self, cursor):
         try:
-            cursor.execute(GET_TOP_IO_QUERIES)
-            rows = cursor.fetchall()
-            for row in rows:
-                text_short = (row.query_text or "")[:500].replace('\n', ' ').strip()
-                SQL_TOP_QUERY_IO.labels(query_text_short=text_short, database=row.database_name).set(row.avg_io)
+            tracker = self.query_stats
+            keep = None
+            if self.query_store is not None:
+                unread = self._read_query_store(cursor, tracker)
+                if unread is None:
+                    return
+                # Databases that failed this time keep their previous totals to diff against
+                keep = lambda key: key[0] in unread
+            else:
+                cursor.execute(GET_QUERY_STATS)
+                tracker.begin(time.monotonic())
+                # Streamed instead of fetchall(): the plan cache can hold 100k+ rows
+                for row in iter_rows(cursor, self.batch_size):
+                    tracker.add(
+                        (row.sql_handle, row.statement_start_offset, row.statement_end_offset),
+                        row.query_hash, row.query_plan_hash, row.plan_handle,
+                        (row.execution_count, row.total_worker_time, row.total_logical_io, row.total_elapsed_time)
+                    )
+                unresolved = tracker.unresolved()
+                if unresolved:
+                    tracker.resolve(self._plan_databases(cursor, unresolved))
+            if not tracker.finish(keep):
+                return  # First pass only records the baseline totals
+
+            # Only the current top N per ranking is exported; queries that dropped
+            # out of it are removed so the series count stays bounded.
+            limit = self.config.get('top_queries_limit', 10)
+            series = self.series['top_queries']
+            series.begin()
+            for metric, field, scale in TOP_QUERY_RANKINGS:
+                for query in tracker.top(field, limit):
+                    self._remember_text(cursor, query)
+                    series.labels(metric, self.instance, query.fingerprint, query.database or 'Unknown').set(query.totals[field] * scale)
+            series.sweep()
         except Exception as e:
-            self.logger.warning(f"Failed to collect Top IO Queries: {e}")
+            self._record_error('top_queries', e)
+            self.logger.warning(f"Failed to collect Top Queries: {e}")
+
+    def _read_query_store(self, cursor, tracker):
+        # Feeds the tracker from every database's Query Store, keyed by
+        # (database, plan_id, runtime_stats_interval_id). Totals are per interval,
+        # so an interval seen again (the open one) is diffed and a new one counts in full.
+        # Returns the databases that weren't read, or None when none could be.
+        cursor.execute(GET_QUERY_STORE_DATABASES)
+        databases = [row.name for row in iter_rows(cursor, self.batch_size)]
+        results = {}
+        statuses = self.query_store.run([
+            (database, partial(self._read_query_store_database, database, results))
+            for database in databases
+        ])
+        if databases and all(statuses.get(database) == 'connecting' for database in databases):
+            # The pool is still logging in; the tracker is left as it was
+            return None
+
+        tracker.begin(time.monotonic())
+        unread = set()
+        for database in databases:
+            rows = results.get(database)
+            if statuses.get(database) != 'ok' or rows is None:
+                # Its intervals and watermark are kept, so the next read diffs against them
+                self.logger.warning(f"Query Store of '{database}' not read this cycle ({statuses.get(database)})")
+                unread.add(database)
+                continue
+            # A database read for the first time (or again after being dropped) starts with a baseline
+            baseline = database not in self.query_store_watermarks
+            for row in rows:
+                tracker.add(
+                    (database, row.plan_id, row.runtime_stats_interval_id),
+                    row.query_hash, row.query_plan_hash, None,
+                    (row.execution_count, row.total_worker_time, row.total_logical_io, row.total_elapsed_time),
+                    baseline, database
+                )
+                if row.runtime_stats_interval_id > self.query_store_watermarks.get(database, -1):
+                    self.query_store_watermarks[database] = row.runtime_stats_interval_id
+        # Forget databases that were dropped or had Query Store turned off
+        for database in set(self.query_store_watermarks) - set(databases):
+            del self.query_store_watermarks[database]
+        return unread
+
+    def _read_query_store_database(self, database, results, cursor):
+        # Runs on a query store pool connection
+        cursor.execute(
+            GET_QUERY_STORE_RUNTIME_STATS.format(database=quote_name(database)),
+            self.query_store_watermarks.get(database, -1)
+        )
+        rows = list(iter_rows(cursor, self.batch_size))
+        EXPORTER_ROWS_FETCHED.labels(self.instance, 'top_queries').inc(len(rows))
+        results[database] = rows
+
+    def _plan_databases(self, cursor, plan_handles):
+        # Database of each newly active cached statement, looked up in batches
+        plan_handles = list(plan_handles)
+        databases = {}
+        for start in range(0, len(plan_handles), PLAN_DATABASE_BATCH):
+            batch = plan_handles[start:start + PLAN_DATABASE_BATCH]
+            cursor.execute(GET_PLAN_DATABASES, ''.join(f"<h>0x{bytes(handle).hex()}</h>" for handle in batch))
+            for row in iter_rows(cursor, self.batch_size):
+                databases[bytes(row.plan_handle)] = row.database_name
+        return databases
+
+    def _remember_text(self, cursor, query):
+        # Text is fetched lazily, once per fingerprint entering the top N
+        if query.fingerprint not in QUERY_TEXTS:
+            if query.plan_handle is None:
+                # Query Store plan: the key carries the database
+                database, plan_id, _ = query.key
+                cursor.execute(GET_QUERY_STORE_TEXT.format(database=quote_name(database)), plan_id, self.max_text_chars)
+            else:
+                sql_handle, start, end = query.key
+                cursor.execute(GET_STATEMENT_TEXT, sql_handle, start, end, self.max_text_chars)
+            row = cursor.fetchone()
+            if row is None:
+                return  # Gone from the cache already; tried again at the next refresh
+            EXPORTER_TEXT_CHARS.labels(self.instance, 'top_queries').inc(len(row.query_text or ''))
+            QUERY_TEXTS.remember(query.fingerprint, row.query_text)
+        QUERY_TEXTS.remember(query.fingerprint, query_plan_hash=query.query_plan_hash)
 
     def _collect_long_running_queries(self, cursor):
         try:
-            cursor.execute(GET_LONG_RUNNING_QUERIES)
-            rows = cursor.fetchall()
-            for row in rows:
-                text_short = (row.query_text or "")[:500].replace('\n', ' ').strip()
-                SQL_LONG_RUNNING_QUERY.labels(
-                    session_id=str(row.session_id), 
-                    query_text_short=text_short, 
-                    database=row.database_name
-                ).set(row.duration_seconds)
+            cursor.execute(GET_LONG_RUNNING_QUERIES, self.row_limits['long_running_queries'], self.max_text_chars)
+            # Finished requests are swept, so each session_id only lives while it runs
+            series = self.series['long_running_queries']
+            series.begin()
+            for row in iter_rows(cursor, self.batch_size):
+                fingerprint = self._remember_query(row)
+                series.labels(SQL_LONG_RUNNING_QUERY, self.instance, row.session_id, fingerprint, row.database_name).set(row.duration_seconds)
+            series.sweep()
         except Exception as e:
+            self._record_error('long_running_queries', e)
             self.logger.warning(f"Failed to collect Long Running Queries: {e}")
+
+    def _remember_query(self, row):
+        # Fingerprint for the metric label; the text goes to the side lookup
+        EXPORTER_TEXT_CHARS.labels(self.instance, 'long_running_queries').inc(len(row.query_text or ''))
+        fingerprint = query_fingerprint(row.query_hash, row.query_text)
+        QUERY_TEXTS.remember(fingerprint, row.query_text, query_plan_hash=row.query_plan_hash)
+        return fingerprint
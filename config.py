@@ -0,0 +1,248 @@
+import json
+import os
+import stat
+
+# Top-level keys that describe the exporter itself rather than a SQL Server connection
+EXPORTER_KEYS = {
+    'targets', 'export_port', 'max_workers', 'target_timeout_seconds', 'query_text_cache_size',
+    'collection_mode', 'scrape_cache_seconds', 'spool_directory', 'spool_segment_max_mb',
+    'spool_segment_max_minutes', 'spool_retention_hours', 'spool_max_mb', 'max_concurrent_logins',
+    'runtime_metrics'
+}
+
+# Expected type of every setting; anything else is reported as unknown (a typo)
+NUMBER = (int, float)
+SETTINGS = {
+    'server': str, 'name': str, 'database': str, 'username': str, 'password': str, 'driver': str,
+    'encrypt': str, 'trust_server_certificate': str, 'targets': list,
+    'collection_interval_seconds': NUMBER, 'export_port': int, 'max_workers': int,
+    'target_timeout_seconds': NUMBER, 'query_timeout_seconds': NUMBER, 'login_timeout_seconds': NUMBER,
+    'lock_timeout_ms': int, 'collector_query_timeouts': dict,
+    'reconnect_backoff_initial_seconds': NUMBER, 'reconnect_backoff_max_seconds': NUMBER,
+    'connection_probe_interval_seconds': NUMBER, 'max_concurrent_logins': int,
+    'collection_engine': str, 'max_connections_per_target': int, 'collector_timeout_seconds': NUMBER,
+    'collection_mode': str, 'scrape_cache_seconds': NUMBER, 'spool_directory': str,
+    'spool_segment_max_mb': NUMBER, 'spool_segment_max_minutes': NUMBER, 'spool_retention_hours': NUMBER,
+    'spool_max_mb': NUMBER, 'query_text_cache_size': int, 'top_queries_limit': int,
+    'top_queries_source': str, 'query_store_max_parallel_databases': int, 'cpu_history_max_minutes': NUMBER,
+    'sampling_interval_seconds': NUMBER, 'sampling_window_seconds': NUMBER, 'sampling_buffer_size': int,
+    'fetch_batch_size': int, 'query_text_max_chars': int, 'row_limits': dict,
+    'tier_intervals_seconds': dict, 'collector_tiers': dict, 'detect_locks': bool,
+    'blocking_chains_limit': int, 'xe_session': str, 'detect_jobs': bool,
+    'detect_long_running_queries': bool, 'long_query_threshold_seconds': NUMBER,
+    'metric_specs_file': str, 'metrics': list, 'runtime_metrics': bool,
+}
+CHOICES = {
+    'collection_mode': ('push', 'pull'),
+    'collection_engine': ('serial', 'async'),
+    'top_queries_source': ('plan_cache', 'query_store'),
+}
+# Settings that must be above zero; every other number must not be negative
+POSITIVE = {
+    'collection_interval_seconds', 'export_port', 'max_workers', 'max_concurrent_logins',
+    'max_connections_per_target', 'query_store_max_parallel_databases', 'fetch_batch_size',
+    'sampling_buffer_size', 'query_text_cache_size',
+}
+REQUIRED_TARGET_KEYS = ('server', 'username', 'password')
+# Mappings of collector (or tier) name to a value, checked entry by entry
+COLLECTOR_SETTINGS = ('row_limits', 'tier_intervals_seconds', 'collector_tiers', 'collector_query_timeouts')
+
+
+class ConfigError(Exception):
+    pass
+
+
+# Where parsed copies of YAML files are kept; None (the default, e.g. for the
+# benchmarks) parses every time. main sets it to the directory of config.yaml.
+CACHE_DIRECTORY = None
+
+
+def set_cache_directory(directory):
+    global CACHE_DIRECTORY
+    CACHE_DIRECTORY = directory
+
+
+def _parse_yaml(stream):
+    # libyaml's loader when PyYAML was built with it: several times faster than the pure Python one
+    import yaml
+    return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def load_yaml(path):
+    # Parsed YAML, through a JSON copy in CACHE_DIRECTORY keyed on the file's path, size
+    # and mtime. Only for files without secrets (metrics.yaml): the copy gets the
+    # file's permissions, but config.yaml holds passwords and is never copied.
+    source = os.stat(path)
+    key = [os.path.abspath(path), source.st_size, source.st_mtime_ns]
+    cache_path = None
+    if CACHE_DIRECTORY is not None:
+        cache_path = os.path.join(CACHE_DIRECTORY, f".{os.path.basename(path)}.json")
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached.get('key') == key:
+                return cached['data']
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    with open(path) as f:
+        data = _parse_yaml(f)
+    if cache_path is None:
+        return data
+    temporary = f"{cache_path}.{os.getpid()}"
+    try:
+        # Created private, then given the source file's mode, so the copy is never
+        # readable by more users than the file itself
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'key': key, 'data': data}, f)
+        os.chmod(temporary, stat.S_IMODE(source.st_mode))
+        os.replace(temporary, cache_path)
+    except (OSError, TypeError, ValueError):
+        # Also values JSON can't hold (YAML dates); the YAML is parsed every time then.
+        # A read-only directory just means no copy.
+        try: os.remove(temporary)
+        except OSError: pass
+    return data
+
+
+def load_config(config_path="config.yaml"):
+    if not os.path.exists(config_path):
+        raise ConfigError(f"Config file {config_path} not found!")
+    try:
+        with open(config_path) as f:
+            config = _parse_yaml(f)
+    except Exception as e:
+        raise ConfigError(f"Failed to read {config_path}: {e}")
+    if not isinstance(config, dict):
+        raise ConfigError(f"{config_path} must be a mapping of settings")
+    return config
+
+
+def _check_setting(key, value, where, problems):
+    expected = SETTINGS.get(key)
+    if expected is None:
+        problems.append(f"{where}unknown setting '{key}'")
+        return
+    if value is None:
+        return
+    # bool is an int subclass; a number setting given true/false is a mistake
+    if not isinstance(value, expected) or (expected is not bool and isinstance(value, bool)):
+        names = ' or '.join(t.__name__ for t in (expected if isinstance(expected, tuple) else (expected,)))
+        problems.append(f"{where}'{key}' must be {names}, got {value!r}")
+        return
+    if key in CHOICES and value not in CHOICES[key]:
+        problems.append(f"{where}'{key}' must be one of {', '.join(CHOICES[key])}, got '{value}'")
+    elif expected is NUMBER or expected is int:
+        if key in POSITIVE and value <= 0:
+            problems.append(f"{where}'{key}' must be greater than 0")
+        elif value < 0:
+            problems.append(f"{where}'{key}' must not be negative")
+
+
+def _positive(value, kinds=NUMBER):
+    return isinstance(value, kinds) and not isinstance(value, bool) and value > 0
+
+
+def _check_collector_settings(target, own, specs, where, problems):
+    # Contents of the per-collector settings. Checked against the target's compiled
+    # metric specs, whose names and tiers add to the built-in ones. A setting
+    # inherited from the top level is reported without the target, once.
+    from collector import DEFAULT_COLLECTOR_TIERS, DEFAULT_ROW_LIMITS, DEFAULT_TIER_INTERVALS
+    collectors = set(DEFAULT_COLLECTOR_TIERS) | {spec.name for spec in specs}
+    row_limited = set(DEFAULT_ROW_LIMITS) | {spec.name for spec in specs if spec.row_limit is not None}
+    intervals = target.get('tier_intervals_seconds') or {}
+    tiers = {'fast', *DEFAULT_TIER_INTERVALS, *intervals}
+
+    def is_tier(value):
+        return _positive(value) or (isinstance(value, str) and value in tiers)
+
+    def at(key):
+        return where if key in own else ''
+
+    for tier, seconds in intervals.items():
+        if tier == 'fast':
+            # The fast tier runs every cycle
+            problems.append(f"{at('tier_intervals_seconds')}'tier_intervals_seconds.fast' is not used, set 'collection_interval_seconds' instead")
+        elif not _positive(seconds):
+            problems.append(f"{at('tier_intervals_seconds')}'tier_intervals_seconds.{tier}' must be a number greater than 0, got {seconds!r}")
+    for name, tier in (target.get('collector_tiers') or {}).items():
+        if name not in collectors:
+            problems.append(f"{at('collector_tiers')}'collector_tiers' has unknown collector '{name}'")
+        elif not is_tier(tier):
+            problems.append(f"{at('collector_tiers')}'collector_tiers.{name}' must be one of {', '.join(sorted(tiers))} or seconds, got {tier!r}")
+    for spec in specs:
+        if not is_tier(spec.tier):
+            problems.append(f"{at('metrics')}metric spec '{spec.name}': tier must be one of {', '.join(sorted(tiers))} or seconds, got {spec.tier!r}")
+    for name, limit in (target.get('row_limits') or {}).items():
+        if name not in row_limited:
+            problems.append(f"{at('row_limits')}'row_limits' has '{name}', which is not one of {', '.join(sorted(row_limited))}")
+        elif not _positive(limit, int):
+            problems.append(f"{at('row_limits')}'row_limits.{name}' must be an integer greater than 0, got {limit!r}")
+    for name, seconds in (target.get('collector_query_timeouts') or {}).items():
+        if name not in collectors:
+            problems.append(f"{at('collector_query_timeouts')}'collector_query_timeouts' has unknown collector '{name}'")
+        elif not isinstance(seconds, NUMBER) or isinstance(seconds, bool) or seconds < 0:
+            problems.append(f"{at('collector_query_timeouts')}'collector_query_timeouts.{name}' must be a number of seconds, got {seconds!r}")
+
+
+def validate_config(config):
+    # Checks every setting and returns the per-target configs (each target merged over
+    # the top-level defaults). All problems are reported at once, before anything starts.
+    problems = []
+    for key, value in config.items():
+        _check_setting(key, value, '', problems)
+
+    defaults = {k: v for k, v in config.items() if k not in EXPORTER_KEYS}
+    targets = config.get('targets') or [{}]
+    target_configs = []
+    checked = []  # (merged, target, where) of every target that is a mapping
+    instances = {}
+    for i, target in enumerate(targets if isinstance(targets, list) else []):
+        if not isinstance(target, dict):
+            problems.append(f"targets[{i}] must be a mapping of settings")
+            continue
+        merged = dict(defaults)
+        merged.update(target)
+        where = f"targets[{i}] ({merged.get('name') or merged.get('server') or 'unnamed'}): "
+        for key, value in target.items():
+            if key in EXPORTER_KEYS:
+                problems.append(f"{where}'{key}' is an exporter setting and can only be set at the top level")
+            else:
+                _check_setting(key, value, where, problems)
+        for key in REQUIRED_TARGET_KEYS:
+            if not merged.get(key):
+                problems.append(f"{where}no '{key}' configured")
+        # Targets sharing an instance label would remove each other's series
+        instance = merged.get('name') or merged.get('server')
+        if instance in instances:
+            problems.append(f"{where}same instance name '{instance}' as targets[{instances[instance]}]; give each target its own 'name'")
+        elif instance:
+            instances[instance] = i
+        target_configs.append(merged)
+        checked.append((merged, target, where))
+
+    # Compiling the metric specs catches their mistakes too (unknown keys, queries);
+    # their names complete the collectors the per-collector settings can refer to
+    from metric_specs import compile_specs, DEFAULT_SPECS_FILE
+    compiled = {}
+    for merged, target, where in checked:
+        specs_file = merged.get('metric_specs_file', DEFAULT_SPECS_FILE)
+        extra = merged.get('metrics')
+        if not isinstance(specs_file, str) or not isinstance(extra, (list, type(None))) or any(
+                not isinstance(merged.get(key), (dict, type(None))) for key in COLLECTOR_SETTINGS):
+            continue  # Already reported as the wrong type
+        key = (specs_file, json.dumps(extra, sort_keys=True, default=str))
+        if key not in compiled:
+            try:
+                compiled[key] = compile_specs(merged.get('name') or merged.get('server') or 'unnamed', specs_file, extra)
+            except Exception as e:
+                problems.append(f"metric specs: {e}")
+                compiled[key] = None
+        if compiled[key] is not None:
+            _check_collector_settings(merged, target, compiled[key], where, problems)
+
+    if problems:
+        # Settings inherited by several targets are reported once
+        raise ConfigError('\n  '.join(['Invalid configuration:'] + list(dict.fromkeys(problems))))
+    return target_configs
@@ -0,0 +1,257 @@
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from queries import LIVENESS_PROBE
+
+# SQLSTATEs meaning the connection itself is gone, as opposed to one query failing
+# (08xxx connection exceptions, 01002 disconnect error, HYT01 connection timeout)
+CONNECTION_SQLSTATES = ('01002', 'HYT01')
+
+# Logins running at once across every target; a restarted exporter or a network
+# blip reconnecting a whole fleet queues here instead of hitting SQL Server together
+LOGIN_SLOTS = threading.BoundedSemaphore(4)
+
+# Prepared statements kept per connection; the least recently used are closed first
+MAX_STATEMENT_CURSORS = 32
+
+
+def set_max_concurrent_logins(count):
+    global LOGIN_SLOTS
+    LOGIN_SLOTS = threading.BoundedSemaphore(max(1, count))
+
+
+def is_connection_error(error):
+    sqlstate = error.args[0] if error.args and isinstance(error.args[0], str) else ''
+    return sqlstate.startswith('08') or sqlstate in CONNECTION_SQLSTATES
+
+
+class ConnectionUnavailable(Exception):
+    pass
+
+
+class StatementCursors:
+    # The cursors of one connection, one per (query timeout, statement) and created on
+    # first use. pyodbc keeps a cursor's last statement prepared, so re-executing the
+    # same query string skips SQLPrepare even for collectors that alternate between
+    # statements (top_queries' stats and text lookups, xevents' position and events).
+    # The query timeout is applied when a cursor is created.
+
+    def __init__(self, conn, capacity=MAX_STATEMENT_CURSORS):
+        self.conn = conn
+        self.capacity = capacity
+        self.cursors = OrderedDict()
+        self.current = None
+
+    def get(self, sql, timeout):
+        key = (timeout, sql)
+        cursor = self.cursors.get(key)
+        if cursor is None:
+            if timeout is not None:
+                self.conn.timeout = timeout
+            cursor = self.cursors[key] = self.conn.cursor()
+            if len(self.cursors) > self.capacity:
+                _, evicted = self.cursors.popitem(last=False)
+                try: evicted.close()
+                except: pass
+        else:
+            self.cursors.move_to_end(key)
+        if self.current is not None and self.current is not cursor:
+            # Without MARS, rows left unread on one statement keep the connection busy;
+            # nextset() discards them and leaves the statement prepared
+            try:
+                while self.current.nextset():
+                    pass
+            except Exception:
+                pass
+        self.current = cursor
+        return cursor
+
+    def cursor(self, timeout=None):
+        return StatementCursor(self, timeout)
+
+    def close(self):
+        cursors, self.cursors = self.cursors, OrderedDict()
+        self.current = None
+        for cursor in cursors.values():
+            try: cursor.close()
+            except: pass
+
+
+class StatementCursor:
+    # What a collector queries through: each execute() goes to the connection's cursor
+    # for that statement, and everything else to the cursor executed last
+
+    def __init__(self, statements, timeout):
+        self.statements = statements
+        self.timeout = timeout
+        self.cursor = None
+
+    def execute(self, sql, *params):
+        self.cursor = self.statements.get(sql, self.timeout)
+        return self.cursor.execute(sql, *params)
+
+    def cancel(self):
+        if self.cursor is not None:
+            self.cursor.cancel()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class ConnectionManager:
+    # Owns the connection a MetricsCollector queries through.
+    #
+    # Logins happen on a background thread, so collection never waits on one: get()
+    # returns the live connection or None. Failed logins back off exponentially with
+    # full jitter (a random delay up to initial * 2^failures, capped), which spreads
+    # a fleet's reconnects out instead of retrying in lockstep every interval.
+    # A connection that has been idle longer than `probe_interval` is checked with
+    # SELECT 1 before it is handed out.
+    #
+    # Cursors are cached per statement for the life of the connection (StatementCursors),
+    # with each collector's own query timeout.
+
+    def __init__(self, login, name, backoff_initial=1, backoff_max=300, probe_interval=60,
+                 query_timeout=0, query_timeouts=None, on_login_error=None, on_reconnect=None):
+        self.login = login
+        self.on_login_error = on_login_error
+        self.on_reconnect = on_reconnect
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.probe_interval = probe_interval
+        self.query_timeout = query_timeout
+        self.query_timeouts = query_timeouts or {}
+        self.conn = None
+        self.statements = None
+        self.checked_at = 0.0
+        self.failures = 0
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+        self.reconnecting = None
+        # Set when a connection was lost, so the login replacing it counts as a reconnect
+        self.lost = False
+        self.stopped = threading.Event()
+        self.logger = logging.getLogger(f"ConnectionManager[{name}]")
+
+    @property
+    def backoff(self):
+        # Seconds until the next login attempt is allowed
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def open(self):
+        # One login, subject to the backoff window and the global login slots.
+        # Also used by the async engine pools and the sampler.
+        if time.monotonic() < self.retry_at:
+            raise ConnectionUnavailable(f"Backing off for {self.backoff:.1f}s after {self.failures} failed login(s)")
+        with LOGIN_SLOTS:
+            try:
+                conn = self.login()
+            except Exception:
+                with self.lock:
+                    self.failures += 1
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_initial * 2 ** self.failures))
+                    self.retry_at = time.monotonic() + delay
+                raise
+        with self.lock:
+            self.failures = 0
+            self.retry_at = 0.0
+        return conn
+
+    def start(self):
+        # Begin connecting in the background if not connected or already trying
+        with self.lock:
+            if self.stopped.is_set() or self.conn is not None or self.reconnecting is not None:
+                return
+            self.reconnecting = threading.Thread(target=self._reconnect, name=f"{self.logger.name}-login", daemon=True)
+            self.reconnecting.start()
+
+    def _reconnect(self):
+        try:
+            while not self.stopped.is_set():
+                delay = self.backoff
+                if delay:
+                    self.stopped.wait(delay)
+                    continue
+                try:
+                    conn = self.open()
+                except ConnectionUnavailable:
+                    continue
+                except Exception as e:
+                    self.logger.error(f"Failed to connect to SQL Server (retry in {self.backoff:.1f}s): {e}")
+                    if self.on_login_error is not None:
+                        self.on_login_error(e)
+                    continue
+                with self.lock:
+                    if self.stopped.is_set():
+                        conn.close()
+                        return
+                    self.conn = conn
+                    self.statements = StatementCursors(conn)
+                    self.checked_at = time.monotonic()
+                    replaced, self.lost = self.lost, False
+                self.logger.info("Connected to SQL Server")
+                if replaced and self.on_reconnect is not None:
+                    self.on_reconnect()
+                return
+        finally:
+            with self.lock:
+                self.reconnecting = None
+
+    def get(self):
+        # The live connection, or None (and a reconnect started) if there is none
+        with self.lock:
+            conn = self.conn
+        if conn is None:
+            self.start()
+            return None
+        if time.monotonic() - self.checked_at > self.probe_interval and not self._probe(conn):
+            self.invalidate()
+            return None
+        self.checked_at = time.monotonic()
+        return conn
+
+    def _probe(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(LIVENESS_PROBE)
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception as e:
+            self.logger.warning(f"Liveness probe failed: {e}")
+            return False
+
+    def timeout_for(self, collector):
+        return self.query_timeouts.get(collector, self.query_timeout)
+
+    def cursor(self, collector):
+        statements = self.statements
+        if statements is None:
+            raise ConnectionUnavailable("Not connected")
+        return statements.cursor(self.timeout_for(collector))
+
+    def invalidate(self):
+        # Drop the connection after a connection-level error; the next get() reconnects
+        with self.lock:
+            conn, self.conn = self.conn, None
+            statements, self.statements = self.statements, None
+        if statements is not None:
+            statements.close()
+        if conn is not None:
+            try: conn.close()
+            except: pass
+            # Every target on a server that just restarted loses its connection at once; the
+            # first retry is jittered too so their logins don't arrive together
+            with self.lock:
+                self.retry_at = max(self.retry_at, time.monotonic() + random.uniform(0, self.backoff_initial))
+                self.lost = True
+            self.logger.info("Connection reset. Reconnecting in the background.")
+
+    def close(self):
+        self.stopped.set()
+        self.invalidate()
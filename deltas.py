@@ -0,0 +1,82 @@
+from array import array
+
+
+class CounterDeltas:
+    # Snapshot-diff store for cumulative DMV counters (sys.dm_os_wait_stats,
+    # sys.dm_io_virtual_file_stats, ...).
+    #
+    # The previous sample of every key lives in flat arrays: one slot per key,
+    # `width` doubles per slot, so tens of thousands of keys cost a few hundred KB
+    # instead of a dict of row objects. Slots of keys that disappear are reused.
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.width = len(self.fields)
+        self.index = {}               # key -> slot
+        self.values = array('d')      # width counters per slot
+        self.sampled_at = array('d')  # time of the previous sample per slot
+        self.generation = array('L')  # sweep generation that last updated the slot
+        self.current = 0
+        self.free = []
+        self.resets = 0               # counter resets seen since startup
+
+    def __len__(self):
+        return len(self.index)
+
+    def _allocate(self, key):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.sampled_at)
+            self.values.extend([0.0] * self.width)
+            self.sampled_at.append(0.0)
+            self.generation.append(0)
+        self.index[key] = slot
+        return slot
+
+    def update(self, key, counters, now):
+        # Store the new sample for `key` and return (deltas, elapsed_seconds),
+        # or None on the first sample of a key.
+        # A counter lower than its previous value means the counters were reset
+        # (instance restart, DBCC SQLPERF(..., CLEAR), file re-attached); the new
+        # cumulative value is then the best estimate of what accrued since.
+        slot = self.index.get(key)
+        first = slot is None
+        if first:
+            slot = self._allocate(key)
+
+        base = slot * self.width
+        values = self.values
+        deltas = None
+        if not first:
+            deltas = [0.0] * self.width
+            reset = False
+            for i in range(self.width):
+                delta = counters[i] - values[base + i]
+                if delta < 0:
+                    reset = True
+                deltas[i] = delta
+            if reset:
+                self.resets += 1
+                deltas = [float(c) for c in counters]
+            elapsed = now - self.sampled_at[slot]
+
+        for i in range(self.width):
+            values[base + i] = counters[i]
+        self.sampled_at[slot] = now
+        self.generation[slot] = self.current
+
+        if deltas is None:
+            return None
+        return deltas, elapsed
+
+    def sweep(self, keep=None):
+        # Forget keys that were not updated since the previous sweep (dropped
+        # databases, files, plans evicted from cache) and start a new generation.
+        # Keys for which keep(key) is true stay (their source wasn't read this time).
+        stale = [key for key, slot in self.index.items()
+                 if self.generation[slot] != self.current and (keep is None or not keep(key))]
+        for key in stale:
+            self.free.append(self.index.pop(key))
+        self.current += 1
+        return len(stale)
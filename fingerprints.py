@@ -0,0 +1,103 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Literal patterns replaced by '?' so statements differing only in constants read the same
+_STRING_LITERAL = re.compile(r"N?'(?:[^']|'')*'")
+_HEX_LITERAL = re.compile(r"\b0x[0-9a-fA-F]+\b")
+_NUMBER_LITERAL = re.compile(r"(?<![\w@#.])[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+
+# Plan hashes remembered per fingerprint (one per recompile that produced a new plan shape)
+MAX_PLAN_HASHES = 8
+
+
+def normalize_query_text(text, max_chars=4000):
+    if not text:
+        return ""
+    text = _STRING_LITERAL.sub("?", text)
+    text = _HEX_LITERAL.sub("?", text)
+    text = _NUMBER_LITERAL.sub("?", text)
+    text = _WHITESPACE.sub(" ", text).strip()
+    return text[:max_chars]
+
+
+def query_hash_fingerprint(query_hash):
+    # query_hash (binary(8), sent as '0x...' by the queries) is stable across
+    # recompiles and literal values. None when the statement has no usable hash.
+    if not query_hash or query_hash == '0x0000000000000000':
+        return None
+    return query_hash[2:].lower() if query_hash.startswith('0x') else query_hash.lower()
+
+
+def query_fingerprint(query_hash, text=None):
+    # Statements without a query_hash (some DDL, system requests) fall back to
+    # a hash of their normalized text.
+    fingerprint = query_hash_fingerprint(query_hash)
+    if fingerprint:
+        return fingerprint
+    normalized = normalize_query_text(text)
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class QueryTextStore:
+    # Side lookup from fingerprint to normalized statement text.
+    # Metrics only carry the 16-character fingerprint; the text is served from
+    # here (see the /queries endpoint). Bounded LRU, shared by all collector threads.
+
+    def __init__(self, capacity=5000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def resize(self, capacity):
+        with self.lock:
+            self.capacity = capacity
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def remember(self, fingerprint, text=None, query_plan_hash=None):
+        # Cheap for fingerprints already stored: the text is only normalized once.
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is None:
+                entry = {
+                    'fingerprint': fingerprint,
+                    'text': normalize_query_text(text),
+                    'query_plan_hashes': [],
+                }
+                self.entries[fingerprint] = entry
+                if len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(fingerprint)
+            entry['last_seen'] = time.time()
+            if query_plan_hash and query_plan_hash not in entry['query_plan_hashes']:
+                entry['query_plan_hashes'].append(query_plan_hash)
+                del entry['query_plan_hashes'][:-MAX_PLAN_HASHES]
+            return entry
+
+    def get(self, fingerprint):
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            return self._copy(entry) if entry else None
+
+    def snapshot(self):
+        # Most recently seen first
+        with self.lock:
+            return [self._copy(entry) for entry in reversed(self.entries.values())]
+
+    @staticmethod
+    def _copy(entry):
+        return dict(entry, query_plan_hashes=list(entry['query_plan_hashes']))
+
+
+QUERY_TEXTS = QueryTextStore()
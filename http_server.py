@@ -0,0 +1,45 @@
+import json
+import threading
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from prometheus_client import make_wsgi_app
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _SilentHandler(WSGIRequestHandler):
+    # Don't log every scrape to stderr
+    def log_message(self, format, *args):
+        pass
+
+
+def json_response(payload, status='200 OK'):
+    return status, 'application/json', json.dumps(payload, default=str).encode('utf-8')
+
+
+def start_exporter_server(port, routes=None, addr='0.0.0.0'):
+    # Like prometheus_client.start_http_server, plus extra JSON endpoints.
+    # routes: {path: handler(query_params) -> (status, content_type, body)}.
+    # Every other path serves the Prometheus metrics.
+    routes = routes or {}
+    metrics_app = make_wsgi_app()
+
+    def app(environ, start_response):
+        handler = routes.get(environ.get('PATH_INFO', '/').rstrip('/'))
+        if handler is None:
+            return metrics_app(environ, start_response)
+        params = {k: v[-1] for k, v in parse_qs(environ.get('QUERY_STRING', '')).items()}
+        try:
+            status, content_type, body = handler(params)
+        except Exception as e:
+            status, content_type, body = json_response({'error': str(e)}, '500 Internal Server Error')
+        start_response(status, [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+        return [body]
+
+    httpd = make_server(addr, port, app, _ThreadingWSGIServer, handler_class=_SilentHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name="exporter-http", daemon=True)
+    thread.start()
+    return httpd
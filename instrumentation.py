@@ -0,0 +1,102 @@
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+# Metrics about the exporter itself (as opposed to the SQL Servers it monitors)
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+EXPORTER_COLLECTOR_DURATION = Histogram('sql_exporter_collector_duration_seconds', 'Time spent in one collector refresh', ['instance', 'collector'], buckets=DURATION_BUCKETS)
+EXPORTER_ROWS_FETCHED = Counter('sql_exporter_rows_fetched', 'Rows fetched from SQL Server', ['instance', 'collector'])
+EXPORTER_TEXT_CHARS = Counter('sql_exporter_query_text_chars', 'Characters of statement text received and processed', ['instance', 'collector'])
+EXPORTER_ERRORS = Counter('sql_exporter_collector_errors', 'Collector failures', ['instance', 'collector', 'error_class'])
+EXPORTER_SERIES_DROPPED = Counter('sql_exporter_series_dropped', 'Label sets not exported because a metric spec reached its max_series', ['instance', 'collector'])
+EXPORTER_RECONNECTS = Counter('sql_exporter_reconnects', 'Logins that replaced a lost connection', ['instance'])
+EXPORTER_SCHEDULER_LAG = Gauge('sql_exporter_scheduler_lag_seconds', 'Time a target waited for a free worker in the last cycle', ['instance'])
+EXPORTER_TARGET_TIMEOUTS = Counter('sql_exporter_target_timeouts', 'Cycles in which a target overran target_timeout_seconds or got no worker', ['instance'])
+EXPORTER_CYCLE_DURATION = Histogram('sql_exporter_cycle_duration_seconds', 'Time to collect all targets once', buckets=DURATION_BUCKETS)
+EXPORTER_LOOP_LAG = Gauge('sql_exporter_loop_lag_seconds', 'How late the last push-mode cycle started compared to its schedule')
+
+
+def error_class(error):
+    # pyodbc errors carry the SQLSTATE as their first argument (e.g. 42000, HYT00 for timeouts)
+    name = type(error).__name__
+    if error.args and isinstance(error.args[0], str) and len(error.args[0]) == 5:
+        return f"{name}:{error.args[0]}"
+    return name
+
+
+class InstrumentedCursor:
+    # Counts the rows a collector fetches and keeps the last error the driver raised
+    # (collectors catch their own, so this is how a lost connection is noticed);
+    # everything else goes to the pyodbc cursor
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rows = 0
+        self.error = None
+
+    def execute(self, *args):
+        try:
+            return self.cursor.execute(*args)
+        except Exception as e:
+            self.error = e
+            raise
+
+    def fetchone(self):
+        try:
+            row = self.cursor.fetchone()
+        except Exception as e:
+            self.error = e
+            raise
+        if row is not None:
+            self.rows += 1
+        return row
+
+    def fetchall(self):
+        try:
+            rows = self.cursor.fetchall()
+        except Exception as e:
+            self.error = e
+            raise
+        self.rows += len(rows)
+        return rows
+
+    def fetchmany(self, size=None):
+        try:
+            rows = self.cursor.fetchmany(size) if size else self.cursor.fetchmany()
+        except Exception as e:
+            self.error = e
+            raise
+        self.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        try:
+            for row in self.cursor:
+                self.rows += 1
+                yield row
+        except Exception as e:
+            self.error = e
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SeriesCountCollector:
+    # Number of series each SQL metric currently holds in the registry.
+    # Computed at scrape time from the metrics themselves.
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def describe(self):
+        yield GaugeMetricFamily('sql_exporter_series', 'Series currently exported per metric', labels=['metric'])
+
+    def collect(self):
+        family = GaugeMetricFamily('sql_exporter_series', 'Series currently exported per metric', labels=['metric'])
+        for metric in self.metrics:
+            for metric_family in metric.collect():
+                # Count series, not samples: a histogram series spans several samples
+                count = sum(1 for sample in metric_family.samples if not sample.name.endswith('_created'))
+                family.add_metric([metric_family.name], count)
+        yield family
@@ -1,10 +1,19 @@
+import gc
 import time
-import yaml
 import logging
-import sys
 import os
-from prometheus_client import start_http_server
-from collector import MetricsCollector
+import sys
+from functools import partial
+from prometheus_client import REGISTRY
+from config import load_config, validate_config, set_cache_directory, ConfigError
+from collector import MetricsCollector, SQL_METRICS
+from metric_specs import SPEC_METRICS
+from fingerprints import QUERY_TEXTS
+from http_server import start_exporter_server, json_response
+from scheduler import CollectionScheduler
+from connections import set_max_concurrent_logins
+from instrumentation import SeriesCountCollector, EXPORTER_LOOP_LAG
+# Modules only some setups use (spool, sampling, pull mode) are imported where they are needed
 
 # Configure Logging
 logging.basicConfig(
@@ -14,38 +23,149 @@ logging.basicConfig(
 )
 logger = logging.getLogger("Main")
 
-def load_config(config_path="config.yaml"):
-    if not os.path.exists(config_path):
-        logger.error(f"Config file {config_path} not found!")
-        sys.exit(1)
-    with open(config_path, "r") as f:
-        return yaml.safe_load(f)
+# Longest time range /spool serves in one response
+MAX_SPOOL_EXPORT_SECONDS = 3600
+
+def query_lookup(params):
+    # /queries                      -> every known fingerprint, most recent first
+    # /queries?fingerprint=<hash>   -> one statement
+    fingerprint = params.get('fingerprint')
+    if fingerprint is None:
+        return json_response(QUERY_TEXTS.snapshot())
+    entry = QUERY_TEXTS.get(fingerprint.lower())
+    if entry is None:
+        return json_response({'error': f"Unknown fingerprint {fingerprint}"}, '404 Not Found')
+    return json_response(entry)
+
+def sample_lookup(samplers, params):
+    # /samples?seconds=60[&instance=<name>][&metric=cpu_percent] -> raw samples per instance and field
+    from sampling import SAMPLED_FIELDS
+    seconds = float(params.get('seconds', 60))
+    instance = params.get('instance')
+    fields = [params['metric']] if 'metric' in params else list(SAMPLED_FIELDS)
+    unknown = [field for field in fields if field not in SAMPLED_FIELDS]
+    if unknown:
+        return json_response({'error': f"Unknown metric {unknown[0]}, expected one of {list(SAMPLED_FIELDS)}"}, '404 Not Found')
+    return json_response({
+        sampler.instance: {field: sampler.samples(field, seconds) for field in fields}
+        for sampler in samplers if instance is None or sampler.instance == instance
+    })
+
+def spool_export(directory, params):
+    # /spool?start=<epoch|ISO 8601>&end=...  -> spooled samples as OpenMetrics, for backfilling.
+    # The response is built in memory, so the range is bounded; spool.py exports longer ones.
+    from spool import replay, to_openmetrics, parse_time, OPENMETRICS_CONTENT_TYPE
+    if 'start' not in params or 'end' not in params:
+        return json_response({'error': "Both 'start' and 'end' are required"}, '400 Bad Request')
+    start, end = parse_time(params['start']), parse_time(params['end'])
+    if not 0 <= end - start <= MAX_SPOOL_EXPORT_SECONDS:
+        return json_response({'error': f"'end' must be after 'start' and at most {MAX_SPOOL_EXPORT_SECONDS // 3600} hour(s) later"}, '400 Bad Request')
+    return '200 OK', OPENMETRICS_CONTENT_TYPE, to_openmetrics(replay(directory, start, end)).encode('utf-8')
 
 def main():
     logger.info("Starting SQL Server Metrics Collector...")
     
-    config = load_config()
+    # Everything is checked before any connection or the HTTP server is started
+    try:
+        # Parsed metric specs are cached next to config.yaml
+        set_cache_directory(os.getcwd())
+        config = load_config()
+        target_configs = validate_config(config)
+    except ConfigError as e:
+        logger.error(str(e))
+        sys.exit(1)
     collection_interval = config.get('collection_interval_seconds', 15)
     export_port = config.get('export_port', 8000)
+    QUERY_TEXTS.resize(config.get('query_text_cache_size', 5000))
     
+    # Initialize one Collector per target, polled concurrently by the scheduler.
+    # Logins start right away in the background; a target that can't be reached yet
+    # is skipped by the cycles until it is.
+    set_max_concurrent_logins(config.get('max_concurrent_logins', 4))
+    collectors = [MetricsCollector(target) for target in target_configs]
+    for collector in collectors:
+        collector.connect()
+    samplers = [c.sampler for c in collectors if c.sampler is not None]
+    # Metric spec metrics exist once the collectors have compiled their specs
+    sql_metrics = SQL_METRICS + tuple(SPEC_METRICS.values())
+    routes = {
+        '/queries': query_lookup,
+        '/samples': partial(sample_lookup, samplers),
+    }
+
+    # Optional local spool of every cycle's samples
+    spool = None
+    spool_directory = config.get('spool_directory')
+    if spool_directory:
+        from spool import Spool
+        spool = Spool(
+            spool_directory,
+            segment_max_bytes=config.get('spool_segment_max_mb', 16) * 1024 * 1024,
+            segment_max_seconds=config.get('spool_segment_max_minutes', 60) * 60,
+            retention_hours=config.get('spool_retention_hours', 48),
+            max_bytes=config.get('spool_max_mb', 512) * 1024 * 1024
+        )
+        routes['/spool'] = partial(spool_export, spool_directory)
+
     # Start Prometheus HTTP Server
     logger.info(f"Starting Prometheus Metrics Server on port {export_port}")
     try:
-        start_http_server(export_port)
+        start_exporter_server(export_port, routes=routes)
     except Exception as e:
         logger.error(f"Failed to start HTTP server: {e}")
         sys.exit(1)
-        
-    # Initialize Collector
-    collector = MetricsCollector(config)
+
+    scheduler = CollectionScheduler(
+        collectors,
+        max_workers=config.get('max_workers', 8),
+        target_timeout=config.get('target_timeout_seconds', collection_interval)
+    )
     
-    logger.info(f"Initialization complete. Starting collection loop (Interval: {collection_interval}s)")
+    def collect_cycle():
+        scheduler.run_cycle()
+        if spool is not None:
+            try:
+                spool.write_snapshot(time.time(), sql_metrics)
+            except Exception as e:
+                logger.error(f"Failed to write spool: {e}")
+
+    REGISTRY.register(SeriesCountCollector(sql_metrics))
+    if samplers:
+        from sampling import SampleSummaryCollector
+        REGISTRY.register(SampleSummaryCollector(samplers))
+    if not config.get('runtime_metrics', True):
+        # Drop prometheus_client's python_* and process_* metrics about the exporter itself
+        from prometheus_client import GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR
+        for runtime_collector in (GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR):
+            REGISTRY.unregister(runtime_collector)
+
+    collection_mode = config.get('collection_mode', 'push')
+    if collection_mode == 'pull':
+        # Query on scrape: the SQL metrics move from the default registry to the on-demand collector
+        from scrape import OnDemandCollector
+        for metric in sql_metrics:
+            REGISTRY.unregister(metric)
+        REGISTRY.register(OnDemandCollector(collect_cycle, sql_metrics, cache_ttl=config.get('scrape_cache_seconds', 5)))
+        logger.info(f"Initialization complete. Collecting {len(collectors)} target(s) with {scheduler.max_workers} worker(s) on scrape")
+    else:
+        logger.info(f"Initialization complete. Collecting {len(collectors)} target(s) with {scheduler.max_workers} worker(s) (Interval: {collection_interval}s)")
     
+    # What was allocated up to here (modules, compiled specs, metric objects) lives as long
+    # as the process; frozen, the garbage collector stops rescanning it every cycle
+    gc.freeze()
+
     # Collection Loop
     try:
+        while collection_mode == 'pull':
+            # Scrapes drive collection; keep the main thread alive for the HTTP server
+            time.sleep(3600)
+
+        next_run = time.time()
         while True:
             start_time = time.time()
-            collector.collect()
+            EXPORTER_LOOP_LAG.set(max(0, start_time - next_run))
+            next_run = start_time + collection_interval
+            collect_cycle()
             elapsed = time.time() - start_time
             logger.info(f"Metrics collected in {elapsed:.2f}s")
             
@@ -54,6 +174,9 @@ def main():
             
     except KeyboardInterrupt:
         logger.info("Stopping collector...")
+        scheduler.shutdown()
+        if spool is not None:
+            spool.close()
         sys.exit(0)
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
@@ -0,0 +1,211 @@
+# Declarative collectors: a query plus how its columns map onto metrics.
+#
+#   - name: db_states
+#     query_ref: GET_DB_STATES        # a constant in queries.py, or `query: SELECT ...`
+#     tier: slow                      # fast / medium / slow or seconds (collector_tiers still overrides)
+#     max_series: 1000                # label sets kept per metric; new ones past the cap are dropped
+#     metrics:
+#       - name: sql_database_state
+#         help: Database state (1=Online)
+#         type: gauge                 # or counter, for cumulative columns
+#         labels: {database: name, state_desc: state_desc}   # label: column
+#         value: is_online
+#
+# Specs are compiled once per target when the collector is created: column names
+# are resolved to row indexes on the first result set, and every label set keeps
+# its metric child, so a row costs a tuple lookup and a set(). Label sets missing
+# from a refresh are removed like SeriesTracker does.
+import os
+from operator import itemgetter
+from prometheus_client import Counter, Gauge
+import queries
+from config import load_yaml
+from instrumentation import EXPORTER_SERIES_DROPPED
+
+DEFAULT_SPECS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.yaml')
+METRIC_TYPES = {'gauge': Gauge, 'counter': Counter}
+SPEC_KEYS = {'name', 'query', 'query_ref', 'tier', 'row_limit', 'toggle', 'max_series', 'metrics'}
+METRIC_KEYS = {'name', 'help', 'type', 'labels', 'value', 'values', 'value_label', 'aggregate'}
+
+# Metrics created from specs, by name. Targets compiling the same spec share them.
+SPEC_METRICS = {}
+
+
+def load_specs(path):
+    return load_yaml(path) or []
+
+
+def _metric(name, kind, documentation, labelnames):
+    metric = SPEC_METRICS.get(name)
+    if metric is None:
+        metric = SPEC_METRICS[name] = METRIC_TYPES[kind](name, documentation, labelnames)
+    elif type(metric) is not METRIC_TYPES[kind] or metric._labelnames != tuple(labelnames):
+        raise ValueError(f"Metric '{name}' is defined twice with different types or labels")
+    return metric
+
+
+def _getter(indexes):
+    # Tuple of the columns at `indexes`
+    if not indexes:
+        return lambda row: ()
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    return itemgetter(*indexes)
+
+
+class MetricMapper:
+    # Maps the rows of a result set onto one metric
+
+    def __init__(self, spec_name, definition, instance, max_series):
+        unknown = set(definition) - METRIC_KEYS
+        if unknown:
+            raise ValueError(f"Metric spec '{spec_name}': unknown keys {sorted(unknown)}")
+        self.name = definition.get('name')
+        self.kind = definition.get('type', 'gauge')
+        if not self.name:
+            raise ValueError(f"Metric spec '{spec_name}': every metric needs a name")
+        if self.kind not in METRIC_TYPES:
+            raise ValueError(f"Metric '{self.name}': type must be one of {sorted(METRIC_TYPES)}")
+        labels = definition.get('labels') or {}
+        self.label_columns = tuple(labels.values())
+        # 'values' exports several columns as one metric, the column name in `value_label`
+        if 'values' in definition:
+            self.value_columns = tuple(definition['values'])
+            self.value_label = definition.get('value_label', 'metric')
+            labelnames = ['instance', *labels, self.value_label]
+        elif 'value' in definition:
+            self.value_columns = (definition['value'],)
+            self.value_label = None
+            labelnames = ['instance', *labels]
+        else:
+            raise ValueError(f"Metric '{self.name}': needs a 'value' or 'values' column")
+        # 'aggregate: sum' adds up the rows sharing a label set (all rows, without labels)
+        self.aggregate = definition.get('aggregate')
+        if self.aggregate not in (None, 'sum'):
+            raise ValueError(f"Metric '{self.name}': aggregate must be 'sum'")
+        self.metric = _metric(self.name, self.kind, definition.get('help') or self.name, labelnames)
+        self.spec_name = spec_name
+        self.instance = instance
+        self.max_series = max_series
+        self.children = {}  # label values -> [child, generation, previous value]
+        self.labels_of = None
+
+    def bind(self, columns):
+        missing = [c for c in self.label_columns + self.value_columns if c not in columns]
+        if missing:
+            raise ValueError(f"Metric '{self.name}': query returned no column {missing[0]}")
+        self.labels_of = _getter([columns.index(c) for c in self.label_columns])
+        self.value_indexes = [(columns.index(c), (c,) if self.value_label else ()) for c in self.value_columns]
+
+    def _child(self, key, generation):
+        entry = self.children.get(key)
+        if entry is None:
+            if len(self.children) >= self.max_series:
+                EXPORTER_SERIES_DROPPED.labels(self.instance, self.spec_name).inc()
+                return None
+            entry = self.children[key] = [self.metric.labels(self.instance, *(str(v) for v in key)), generation, None]
+        entry[1] = generation
+        return entry
+
+    def _export(self, entry, value):
+        if self.kind == 'gauge':
+            entry[0].set(value)
+            return
+        # Counters follow a cumulative column: the first value in full, then what it
+        # grew by; a column that went down (server restart) counts from zero again
+        previous = entry[2]
+        entry[0].inc(value if previous is None or value < previous else value - previous)
+        entry[2] = value
+
+    def add_rows(self, rows, generation):
+        totals = {} if self.aggregate else None
+        if totals is not None and not self.label_columns:
+            for _, suffix in self.value_indexes:
+                totals[suffix] = 0
+        for row in rows:
+            labels = self.labels_of(row)
+            for index, suffix in self.value_indexes:
+                value = row[index]
+                if value is None:
+                    continue
+                key = labels + suffix
+                if totals is not None:
+                    totals[key] = totals.get(key, 0) + value
+                    continue
+                entry = self._child(key, generation)
+                if entry is not None:
+                    self._export(entry, value)
+        if totals is not None:
+            for key, value in totals.items():
+                entry = self._child(key, generation)
+                if entry is not None:
+                    self._export(entry, value)
+
+    def sweep(self, generation):
+        for key, entry in list(self.children.items()):
+            if entry[1] != generation:
+                del self.children[key]
+                try:
+                    self.metric.remove(self.instance, *(str(v) for v in key))
+                except KeyError:
+                    pass
+
+
+class SpecCollector:
+    # One compiled spec for one target
+
+    def __init__(self, spec, instance):
+        name = spec.get('name')
+        if not name:
+            raise ValueError(f"Metric spec without a name: {spec}")
+        unknown = set(spec) - SPEC_KEYS
+        if unknown:
+            raise ValueError(f"Metric spec '{name}': unknown keys {sorted(unknown)}")
+        if 'query_ref' in spec:
+            self.query = getattr(queries, spec['query_ref'], None)
+            if not isinstance(self.query, str):
+                raise ValueError(f"Metric spec '{name}': queries.py has no query {spec['query_ref']}")
+        elif spec.get('query'):
+            self.query = spec['query']
+        else:
+            raise ValueError(f"Metric spec '{name}': needs a 'query' or 'query_ref'")
+        if not spec.get('metrics'):
+            raise ValueError(f"Metric spec '{name}': no metrics")
+        self.name = name
+        self.tier = spec.get('tier', 'fast')
+        self.row_limit = spec.get('row_limit')
+        self.toggle = spec.get('toggle')
+        self.mappers = [MetricMapper(name, definition, instance, spec.get('max_series', 1000)) for definition in spec['metrics']]
+        self.columns = None
+        self.generation = 0
+
+    def collect(self, cursor, rows, row_limit=None):
+        # `rows` streams the result set of the query run on `cursor`
+        if self.row_limit is None:
+            cursor.execute(self.query)
+        else:
+            cursor.execute(self.query, row_limit or self.row_limit)
+        columns = tuple(column[0] for column in cursor.description)
+        if columns != self.columns:
+            for mapper in self.mappers:
+                mapper.bind(columns)
+            self.columns = columns
+        self.generation += 1
+        if len(self.mappers) == 1:
+            self.mappers[0].add_rows(rows(cursor), self.generation)
+        else:
+            batch = list(rows(cursor))
+            for mapper in self.mappers:
+                mapper.add_rows(batch, self.generation)
+        for mapper in self.mappers:
+            mapper.sweep(self.generation)
+
+
+def compile_specs(instance, path=DEFAULT_SPECS_FILE, extra=None):
+    # The built-in specs plus the config's own 'metrics'; a spec in the config
+    # replaces the built-in one with the same name
+    specs = {}
+    for spec in (load_specs(path) if path else []) + list(extra or []):
+        specs[spec.get('name')] = spec
+    return [SpecCollector(spec, instance) for spec in specs.values()]
@@ -1,20 +1,38 @@
 
 # queries.py
 
-# CPU Usage (using ring buffers for historical data, picking the latest)
+# Cheap round trip to check that an idle connection still works
+LIVENESS_PROBE = "SELECT 1;"
+
+# Applied once per connection: DMV queries that hit a lock (msdb job history,
+# sys.databases during a restore) fail after this long instead of queueing behind it
+SET_LOCK_TIMEOUT = "SET LOCK_TIMEOUT {lock_timeout_ms};"
+
+# CPU Usage (per-minute scheduler monitor records from the ring buffer)
+# Only records newer than the last one the exporter processed are converted to XML;
+# the timestamp filter runs on the raw rows first. A watermark ahead of ms_ticks means
+# the instance restarted, and then everything in the buffer is new.
+# @max_age_ms bounds how far back the first read (or a read after an outage) goes.
+# age_ms turns the ring buffer's ms_ticks timestamp into wall-clock time on the exporter side.
 GET_CPU_USAGE = """
-SELECT TOP 1
-    [SQLProcessUtilization] = record.value('(./Record/SchedulerMonitorEvent/SystemHealth/ProcessUtilization)[1]', 'int'),
-    [SystemIdle] = record.value('(./Record/SchedulerMonitorEvent/SystemHealth/SystemIdle)[1]', 'int'),
-    [OtherProcessUtilization] = 100 - record.value('(./Record/SchedulerMonitorEvent/SystemHealth/ProcessUtilization)[1]', 'int') 
-    - record.value('(./Record/SchedulerMonitorEvent/SystemHealth/SystemIdle)[1]', 'int')
+DECLARE @last_timestamp bigint = ?, @max_age_ms bigint = ?;
+SELECT
+    x.timestamp,
+    x.age_ms,
+    [SQLProcessUtilization] = x.record.value('(./Record/SchedulerMonitorEvent/SystemHealth/ProcessUtilization)[1]', 'int'),
+    [SystemIdle] = x.record.value('(./Record/SchedulerMonitorEvent/SystemHealth/SystemIdle)[1]', 'int'),
+    [OtherProcessUtilization] = 100 - x.record.value('(./Record/SchedulerMonitorEvent/SystemHealth/ProcessUtilization)[1]', 'int') 
+    - x.record.value('(./Record/SchedulerMonitorEvent/SystemHealth/SystemIdle)[1]', 'int')
 FROM (
-    SELECT timestamp, CONVERT(xml, record) AS record
-    FROM sys.dm_os_ring_buffers
-    WHERE ring_buffer_type = N'RING_BUFFER_SCHEDULER_MONITOR'
-    AND record LIKE '%<SystemHealth>%'
+    SELECT rb.timestamp, si.ms_ticks - rb.timestamp AS age_ms, CONVERT(xml, rb.record) AS record
+    FROM sys.dm_os_ring_buffers rb
+    CROSS JOIN sys.dm_os_sys_info si
+    WHERE rb.ring_buffer_type = N'RING_BUFFER_SCHEDULER_MONITOR'
+    AND (rb.timestamp > @last_timestamp OR @last_timestamp > si.ms_ticks)
+    AND rb.timestamp > si.ms_ticks - @max_age_ms
+    AND rb.record LIKE N'%<SystemHealth>%'
 ) AS x
-ORDER BY timestamp DESC;
+ORDER BY x.timestamp;
 """
 
 # Memory Usage
@@ -22,39 +40,37 @@ GET_MEMORY_USAGE = """
 SELECT
     physical_memory_in_use_kb,
     large_page_allocations_kb,
-    locked_page_allocations_kb,
-    page_fault_count,
-    memory_utilization_percentage,
-    process_physical_memory_low,
-    process_virtual_memory_low
+    page_fault_count
 FROM sys.dm_os_process_memory;
 """
 
 # I/O Stats (Latency and Throughput per database file)
+# Capped at @max_rows files, busiest first
 GET_IO_STATS = """
-SELECT
+DECLARE @max_rows int = ?;
+SELECT TOP (@max_rows)
     DB_NAME(mf.database_id) AS database_name,
     mf.name AS logical_name,
-    mf.type_desc,
     vfs.num_of_reads,
     vfs.num_of_bytes_read,
     vfs.io_stall_read_ms,
     vfs.num_of_writes,
     vfs.num_of_bytes_written,
-    vfs.io_stall_write_ms,
-    vfs.size_on_disk_bytes
+    vfs.io_stall_write_ms
 FROM sys.dm_io_virtual_file_stats(NULL, NULL) AS vfs
-JOIN sys.master_files AS mf ON vfs.database_id = mf.database_id AND vfs.file_id = mf.file_id;
+JOIN sys.master_files AS mf ON vfs.database_id = mf.database_id AND vfs.file_id = mf.file_id
+ORDER BY vfs.io_stall_read_ms + vfs.io_stall_write_ms DESC;
 """
 
 # Wait Stats (System wide)
 # Filtering out benign waits is important to avoid noise
+# Capped at @max_rows wait types, longest first
 GET_WAIT_STATS = """
-SELECT
+DECLARE @max_rows int = ?;
+SELECT TOP (@max_rows)
     wait_type,
     waiting_tasks_count,
     wait_time_ms,
-    max_wait_time_ms,
     signal_wait_time_ms
 FROM sys.dm_os_wait_stats
 WHERE wait_time_ms > 0
@@ -75,100 +91,221 @@ AND wait_type NOT IN (
     'SQLTRACE_WAIT_ENTRIES', 'WAIT_FOR_RESULTS', 'WAITFOR', 'WAITFOR_TASKSHUTDOWN', 'WAIT_XTP_RECOVERY',
     'WAIT_XTP_HOST_WAIT', 'WAIT_XTP_OFFLINE_CKPT_NEW_LOG', 'WAIT_XTP_CKPT_CLOSE', 'XE_DISPATCHER_JOIN',
     'XE_DISPATCHER_WAIT', 'XE_TIMER_EVENT'
-);
+)
+ORDER BY wait_time_ms DESC;
 """
 
-# User Error Logs (Recent errors - Sev > 10)
+# User Error Logs (exceptions recorded in the ring buffer)
+# Incremental like GET_CPU_USAGE: only exceptions newer than the last processed timestamp.
+# The exporter only counts them, so the records are never converted to XML.
 GET_RECENT_EXCEPTIONS = """
-SELECT TOP 20
-    Error = record.value('(./Record/Exception/Error)[1]', 'int'),
-    Severity = record.value('(./Record/Exception/Severity)[1]', 'int'),
-    State = record.value('(./Record/Exception/State)[1]', 'int'),
-    Message = record.value('(./Record/Exception/UserDefinedMsg)[1]', 'varchar(max)'),
-    pct = record.value('(./Record/Exception/UserDefinedMsg)[1]', 'varchar(max)'),
-    CreationTime = record.value('(./Record/@time)[1]', 'bigint')
-FROM (
-    SELECT timestamp, CONVERT(xml, record) AS record
-    FROM sys.dm_os_ring_buffers
-    WHERE ring_buffer_type = 'RING_BUFFER_EXCEPTION'
-) AS x
-ORDER BY timestamp DESC;
+DECLARE @last_timestamp bigint = ?, @max_age_ms bigint = ?;
+SELECT TOP 1000
+    rb.timestamp
+FROM sys.dm_os_ring_buffers rb
+CROSS JOIN sys.dm_os_sys_info si
+WHERE rb.ring_buffer_type = N'RING_BUFFER_EXCEPTION'
+AND (rb.timestamp > @last_timestamp OR @last_timestamp > si.ms_ticks)
+AND rb.timestamp > si.ms_ticks - @max_age_ms
+ORDER BY rb.timestamp;
+"""
+
+# Extended Events (deadlocks, lock timeouts, errors)
+# Read from the event_file target of an XE session (system_health by default).
+# The target's current file name, e.g. ...\system_health_0_133612345678900000.xel,
+# is turned into a pattern matching all of the session's rollover files.
+XE_EVENT_FILE = """
+DECLARE @session sysname = ?, @path nvarchar(260);
+SELECT @path = CAST(t.target_data AS xml).value('(EventFileTarget/File/@name)[1]', 'nvarchar(260)')
+FROM sys.dm_xe_sessions s
+JOIN sys.dm_xe_session_targets t ON t.event_session_address = s.address
+WHERE s.name = @session AND t.target_name = N'event_file';
+SET @path = LEFT(@path, LEN(@path) - CHARINDEX(N'_', REVERSE(@path))) + N'*.xel';
+"""
+
+# End of the session's files: where reading starts, so history isn't counted at startup.
+# Also whether the session captures lock_timeout events (error 1222 counts otherwise).
+GET_XE_POSITION = XE_EVENT_FILE + """
+SELECT TOP 1
+    x.file_name,
+    x.file_offset,
+    CASE WHEN EXISTS (
+        SELECT 1
+        FROM sys.server_event_sessions ss
+        JOIN sys.server_event_session_events e ON e.event_session_id = ss.event_session_id
+        WHERE ss.name = @session AND e.name IN (N'lock_timeout', N'lock_timeout_greater_than_0')
+    ) THEN 1 ELSE 0 END AS has_lock_timeout_events
+FROM sys.fn_xe_file_target_read_file(@path, NULL, NULL, NULL) x
+WHERE @path IS NOT NULL
+ORDER BY x.file_name DESC, x.file_offset DESC;
+"""
+
+# Events in the buffers after (file_name, file_offset), in file order. Only
+# error_reported needs its XML; deadlock graphs are counted without being sent.
+GET_XE_EVENTS = XE_EVENT_FILE + """
+DECLARE @file_name nvarchar(260) = ?, @file_offset bigint = ?, @max_rows int = ?;
+SELECT TOP (@max_rows)
+    x.object_name,
+    x.file_name,
+    x.file_offset,
+    CASE WHEN x.object_name = N'error_reported' THEN x.event_data END AS event_data
+FROM sys.fn_xe_file_target_read_file(@path, NULL, @file_name, @file_offset) x
+WHERE x.object_name IN (N'xml_deadlock_report', N'lock_timeout', N'lock_timeout_greater_than_0', N'error_reported');
 """
 
 # Active Sessions & Blocking
-# Gets sessions with active requests or blocking others
+# User requests counted by status and database on the server, so the result
+# stays a few rows however many sessions are connected.
 GET_ACTIVE_SESSIONS = """
 SELECT
-    s.session_id,
-    s.login_name,
-    s.host_name,
-    s.program_name,
     r.status,
-    r.command,
-    r.cpu_time,
-    r.total_elapsed_time,
-    r.wait_type,
-    r.wait_time,
-    r.last_wait_type,
-    r.blocking_session_id,
-    DB_NAME(r.database_id) AS database_name,
-    t.text AS query_text
+    ISNULL(DB_NAME(r.database_id), N'Unknown') AS database_name,
+    COUNT(*) AS session_count,
+    SUM(CASE WHEN r.blocking_session_id > 0 THEN 1 ELSE 0 END) AS blocked_count
 FROM sys.dm_exec_requests r
 JOIN sys.dm_exec_sessions s ON r.session_id = s.session_id
-CROSS APPLY sys.dm_exec_sql_text(r.sql_handle) t
-WHERE s.is_user_process = 1;
+WHERE s.is_user_process = 1
+GROUP BY r.status, DB_NAME(r.database_id);
+"""
+
+# Blocking edges: one row per blocked request with the session blocking it.
+# Chains and head blockers are resolved by the exporter (blocking.py).
+# Negative blocking_session_id values (orphaned DTC, latch owners) are not sessions.
+GET_BLOCKING_EDGES = """
+DECLARE @max_rows int = ?;
+SELECT TOP (@max_rows)
+    r.session_id,
+    r.blocking_session_id,
+    r.wait_time
+FROM sys.dm_exec_requests r
+WHERE r.blocking_session_id > 0
+AND r.blocking_session_id <> r.session_id
+ORDER BY r.wait_time DESC;
+"""
+
+# High-frequency sample (sampling_interval_seconds): one cheap row per tick.
+# CPU comes from the Resource Pool Stats counters, which track the current CPU use
+# of SQL Server; the ring buffer behind GET_CPU_USAGE only has one record a minute.
+# The ratio counter shares one base across pools, so the pools' values are summed over it.
+GET_HIGH_FREQUENCY_SAMPLE = """
+SELECT
+    (SELECT SUM(CASE WHEN counter_name = 'CPU usage %' THEN cntr_value END) * 100.0
+        / NULLIF(MAX(CASE WHEN counter_name = 'CPU usage % base' THEN cntr_value END), 0)
+     FROM sys.dm_os_performance_counters
+     WHERE object_name LIKE '%Resource Pool Stats%') AS cpu_percent,
+    (SELECT COUNT(*)
+     FROM sys.dm_exec_requests r
+     JOIN sys.dm_exec_sessions s ON r.session_id = s.session_id
+     WHERE s.is_user_process = 1) AS active_requests,
+    (SELECT COUNT(*)
+     FROM sys.dm_exec_requests
+     WHERE blocking_session_id > 0) AS blocked_requests;
 """
 
 # Problematic Queries (Long running or high CPU in cache)
-# Top 10 by CPU
-GET_TOP_CPU_QUERIES = """
-SELECT TOP 10
-    qs.execution_count,
-    qs.total_worker_time / 1000 AS total_cpu_ms,
-    qs.total_worker_time / ISNULL(NULLIF(qs.execution_count, 0), 1) / 1000 AS avg_cpu_ms,
-    qs.total_elapsed_time / 1000 AS total_duration_ms,
-    qs.total_elapsed_time / ISNULL(NULLIF(qs.execution_count, 0), 1) / 1000 AS avg_duration_ms,
-    SUBSTRING(qt.text, (qs.statement_start_offset/2)+1,
-        ((CASE qs.statement_end_offset
-            WHEN -1 THEN DATALENGTH(qt.text)
-            ELSE qs.statement_end_offset
-        END - qs.statement_start_offset)/2) + 1) AS query_text,
-    DB_NAME(qp.dbid) AS database_name
-FROM sys.dm_exec_query_stats qs
-CROSS APPLY sys.dm_exec_sql_text(qs.sql_handle) qt
-CROSS APPLY sys.dm_exec_query_plan(qs.plan_handle) qp
-ORDER BY qs.total_worker_time DESC;
-"""
-
-# Top 10 by I/O (Reads + Writes)
-GET_TOP_IO_QUERIES = """
-SELECT TOP 10
-    qs.execution_count,
-    (qs.total_logical_reads + qs.total_logical_writes) AS total_io,
-    (qs.total_logical_reads + qs.total_logical_writes) / ISNULL(NULLIF(qs.execution_count, 0), 1) AS avg_io,
-    qs.total_elapsed_time / 1000 AS total_duration_ms,
-    SUBSTRING(qt.text, (qs.statement_start_offset/2)+1,
-        ((CASE qs.statement_end_offset
-            WHEN -1 THEN DATALENGTH(qt.text)
-            ELSE qs.statement_end_offset
-        END - qs.statement_start_offset)/2) + 1) AS query_text,
-    DB_NAME(qp.dbid) AS database_name
+# One pass over the plan cache with numeric columns only: no sql_text, no query plan,
+# no sort. The exporter diffs these lifetime totals between passes and ranks the
+# top statements by what they consumed in the interval.
+# Rows are grouped by (sql_handle, offsets) because a statement can have several cached plans.
+# query_hash identifies the statement independently of literals and recompiles;
+# it is what the exporter labels these metrics with.
+GET_QUERY_STATS = """
+SELECT
+    qs.sql_handle,
+    qs.statement_start_offset,
+    qs.statement_end_offset,
+    MAX(qs.plan_handle) AS plan_handle,
+    CONVERT(varchar(18), MAX(qs.query_hash), 1) AS query_hash,
+    CONVERT(varchar(18), MAX(qs.query_plan_hash), 1) AS query_plan_hash,
+    SUM(qs.execution_count) AS execution_count,
+    SUM(qs.total_worker_time) AS total_worker_time,
+    SUM(qs.total_logical_reads + qs.total_logical_writes) AS total_logical_io,
+    SUM(qs.total_elapsed_time) AS total_elapsed_time
 FROM sys.dm_exec_query_stats qs
-CROSS APPLY sys.dm_exec_sql_text(qs.sql_handle) qt
-CROSS APPLY sys.dm_exec_query_plan(qs.plan_handle) qp
-ORDER BY (qs.total_logical_reads + qs.total_logical_writes) DESC;
+GROUP BY qs.sql_handle, qs.statement_start_offset, qs.statement_end_offset;
+"""
+
+# Statement text and database for one cached statement.
+# Only run for statements entering the top N that the exporter hasn't seen yet.
+# The text is cut to @max_text_chars on the server.
+GET_STATEMENT_TEXT = """
+DECLARE @sql_handle varbinary(64) = ?, @start int = ?, @end int = ?, @max_text_chars int = ?;
+SELECT
+    LEFT(SUBSTRING(t.text, (@start/2)+1,
+        ((CASE @end
+            WHEN -1 THEN DATALENGTH(t.text)
+            ELSE @end
+        END - @start)/2) + 1), @max_text_chars) AS query_text
+FROM sys.dm_exec_sql_text(@sql_handle) t;
+"""
+# Database each plan was compiled in, for a list of <h>0x...</h> plan handles
+# (XML rather than STRING_SPLIT, which needs compatibility level 130)
+GET_PLAN_DATABASES = """
+DECLARE @plan_handles xml = ?;
+SELECT
+    h.plan_handle,
+    DB_NAME(CONVERT(int, pa.value)) AS database_name
+FROM (
+    SELECT CONVERT(varbinary(64), n.value('.', 'varchar(130)'), 1) AS plan_handle
+    FROM @plan_handles.nodes('/h') AS x(n)
+) h
+CROSS APPLY sys.dm_exec_plan_attributes(h.plan_handle) pa
+WHERE pa.attribute = N'dbid';
+"""
+
+# Query Store mode (top_queries_source: query_store)
+# Databases whose Query Store can be read
+GET_QUERY_STORE_DATABASES = """
+SELECT name
+FROM sys.databases
+WHERE is_query_store_on = 1
+AND state_desc = 'ONLINE';
+"""
+
+# Runtime stats of one database ({database} is the bracket-quoted name) from the
+# @last_interval_id watermark on. The newest interval is still open and read again
+# next time; the exporter diffs its totals. A negative watermark (first read) means
+# the newest interval only, rather than the whole Query Store history.
+GET_QUERY_STORE_RUNTIME_STATS = """
+DECLARE @last_interval_id bigint = ?;
+DECLARE @from_interval_id bigint = CASE WHEN @last_interval_id >= 0 THEN @last_interval_id
+    ELSE (SELECT ISNULL(MAX(runtime_stats_interval_id), 0) FROM {database}.sys.query_store_runtime_stats_interval) END;
+SELECT
+    rs.plan_id,
+    rs.runtime_stats_interval_id,
+    CONVERT(varchar(18), q.query_hash, 1) AS query_hash,
+    CONVERT(varchar(18), p.query_plan_hash, 1) AS query_plan_hash,
+    SUM(rs.count_executions) AS execution_count,
+    SUM(rs.count_executions * rs.avg_cpu_time) AS total_worker_time,
+    SUM(rs.count_executions * (rs.avg_logical_io_reads + rs.avg_logical_io_writes)) AS total_logical_io,
+    SUM(rs.count_executions * rs.avg_duration) AS total_elapsed_time
+FROM {database}.sys.query_store_runtime_stats rs
+JOIN {database}.sys.query_store_plan p ON p.plan_id = rs.plan_id
+JOIN {database}.sys.query_store_query q ON q.query_id = p.query_id
+WHERE rs.runtime_stats_interval_id >= @from_interval_id
+GROUP BY rs.plan_id, rs.runtime_stats_interval_id, q.query_hash, p.query_plan_hash;
+"""
+
+# Statement text of one Query Store plan, cut to @max_text_chars on the server
+GET_QUERY_STORE_TEXT = """
+DECLARE @plan_id bigint = ?, @max_text_chars int = ?;
+SELECT LEFT(qt.query_sql_text, @max_text_chars) AS query_text
+FROM {database}.sys.query_store_plan p
+JOIN {database}.sys.query_store_query q ON q.query_id = p.query_id
+JOIN {database}.sys.query_store_query_text qt ON qt.query_text_id = q.query_text_id
+WHERE p.plan_id = @plan_id;
 """
 
 # Long Running Queries (> Threshold)
+# Text is cut to @max_text_chars on the server
 GET_LONG_RUNNING_QUERIES = """
-SELECT TOP 10
+DECLARE @max_rows int = ?, @max_text_chars int = ?;
+SELECT TOP (@max_rows)
     r.session_id,
-    r.status,
     r.total_elapsed_time / 1000.0 AS duration_seconds,
-    r.cpu_time / 1000.0 AS cpu_seconds,
-    r.wait_type,
-    r.wait_time / 1000.0 AS wait_seconds,
-    t.text AS query_text,
+    CONVERT(varchar(18), r.query_hash, 1) AS query_hash,
+    CONVERT(varchar(18), r.query_plan_hash, 1) AS query_plan_hash,
+    LEFT(t.text, @max_text_chars) AS query_text,
     DB_NAME(r.database_id) AS database_name
 FROM sys.dm_exec_requests r
 CROSS APPLY sys.dm_exec_sql_text(r.sql_handle) t
@@ -178,22 +315,23 @@ ORDER BY r.total_elapsed_time DESC;
 """
 
 # Failed Jobs (Last 24 hours)
+# One row per job, most recent failure first
 GET_FAILED_JOBS = """
-SELECT
+DECLARE @max_rows int = ?;
+SELECT TOP (@max_rows)
     j.name AS job_name,
-    h.run_status,
-    h.run_date,
-    h.run_time,
-    h.message
+    1 AS failed
 FROM msdb.dbo.sysjobs j
 INNER JOIN msdb.dbo.sysjobhistory h ON j.job_id = h.job_id
 WHERE h.run_status = 0 -- Failed
 AND h.run_date >= CONVERT(varchar(8), GETDATE(), 112) -- Today (simplification)
-ORDER BY h.instance_id DESC;
+GROUP BY j.name
+ORDER BY MAX(h.instance_id) DESC;
 """
 
 # Database States (Offline, Recovery, etc.)
 GET_DB_STATES = """
-SELECT name, state_desc, user_access_desc, is_read_only
+SELECT name, state_desc,
+    CASE WHEN state_desc = 'ONLINE' THEN 1 ELSE 0 END AS is_online
 FROM sys.databases;
 """
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from array import array
+from prometheus_client.core import GaugeMetricFamily
+from connections import ConnectionUnavailable
+from queries import GET_HIGH_FREQUENCY_SAMPLE
+
+# Columns of GET_HIGH_FREQUENCY_SAMPLE -> (summary metric, help)
+SAMPLED_FIELDS = {
+    'cpu_percent': ('sql_sampled_cpu_percent', 'SQL Server CPU usage sampled between scrapes'),
+    'active_requests': ('sql_sampled_active_requests', 'User requests running or waiting, sampled between scrapes'),
+    'blocked_requests': ('sql_sampled_blocked_requests', 'Requests blocked by another session, sampled between scrapes'),
+}
+SUMMARY_STATS = ('min', 'max', 'avg', 'p95')
+
+
+class SampleRing:
+    # Fixed-size ring of (timestamp, value) pairs in two preallocated double arrays;
+    # the oldest sample is overwritten once the ring is full
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.next = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        self.timestamps[self.next] = timestamp
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def since(self, start):
+        # Samples taken at or after `start`, oldest first
+        samples = []
+        first = (self.next - self.count) % self.capacity
+        for i in range(self.count):
+            slot = (first + i) % self.capacity
+            if self.timestamps[slot] >= start:
+                samples.append((self.timestamps[slot], self.values[slot]))
+        return samples
+
+
+def summarize(values):
+    # min, max, avg and nearest-rank p95 of a non-empty list
+    ordered = sorted(values)
+    p95 = ordered[max(0, -(-len(ordered) * 95 // 100) - 1)]
+    return ordered[0], ordered[-1], sum(ordered) / len(ordered), p95
+
+
+class Sampler:
+    # High-frequency sampling of cheap DMVs for one instance.
+    #
+    # Runs on its own thread and connection, independent of the collection cycle,
+    # every `interval` seconds. Samples go into one SampleRing per field, so memory
+    # is fixed at `capacity` samples per field however long the exporter runs.
+    # Prometheus sees min/max/avg/p95 over the last `window` seconds
+    # (SampleSummaryCollector); the raw samples are served by /samples.
+
+    def __init__(self, connect, instance, interval=1, capacity=600, window=30):
+        self.connect = connect
+        self.instance = instance
+        self.interval = interval
+        self.window = window
+        self.rings = {field: SampleRing(capacity) for field in SAMPLED_FIELDS}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger(f"Sampler[{instance}]")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f"sampler-{self.instance}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        conn = None
+        failing = False
+        next_run = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                if conn is None:
+                    conn = self.connect()
+                cursor = conn.cursor()
+                cursor.execute(GET_HIGH_FREQUENCY_SAMPLE)
+                row = cursor.fetchone()
+                cursor.close()
+                if row:
+                    self.add(time.time(), row)
+                if failing:
+                    self.logger.info("Sampling resumed")
+                    failing = False
+            except ConnectionUnavailable:
+                pass  # Logins are backing off; the failure that caused it was already logged
+            except Exception as e:
+                # Logged once when sampling stops working, not on every tick until it recovers
+                if not failing:
+                    self.logger.warning(f"Sampling failed: {e}")
+                    failing = True
+                else:
+                    self.logger.debug(f"Sampling failed: {e}")
+                if conn is not None:
+                    try: conn.close()
+                    except: pass
+                conn = None
+            # Fixed schedule; ticks missed while the query or a reconnect ran long are skipped
+            next_run += self.interval
+            now = time.monotonic()
+            if next_run < now:
+                next_run = now
+            self.stopped.wait(next_run - now)
+        if conn is not None:
+            try: conn.close()
+            except: pass
+
+    def add(self, timestamp, row):
+        with self.lock:
+            for field, ring in self.rings.items():
+                value = getattr(row, field)
+                if value is not None:
+                    ring.append(timestamp, float(value))
+
+    def samples(self, field, seconds):
+        with self.lock:
+            return self.rings[field].since(time.time() - seconds)
+
+    def summary(self, field):
+        samples = self.samples(field, self.window)
+        if not samples:
+            return None
+        return summarize([value for _, value in samples])
+
+
+class SampleSummaryCollector:
+    # Exports each sampler's window statistics as <metric>{instance, stat}
+
+    def __init__(self, samplers):
+        self.samplers = samplers
+
+    def _families(self):
+        return {field: GaugeMetricFamily(name, doc, labels=['instance', 'stat']) for field, (name, doc) in SAMPLED_FIELDS.items()}
+
+    def describe(self):
+        yield from self._families().values()
+
+    def collect(self):
+        families = self._families()
+        for sampler in self.samplers:
+            for field, family in families.items():
+                summary = sampler.summary(field)
+                if summary is None:
+                    continue
+                for stat, value in zip(SUMMARY_STATS, summary):
+                    family.add_metric([sampler.instance, stat], value)
+        yield from families.values()
@@ -0,0 +1,85 @@
+import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from instrumentation import EXPORTER_SCHEDULER_LAG, EXPORTER_TARGET_TIMEOUTS, EXPORTER_CYCLE_DURATION
+
+
+class CollectionScheduler:
+    # Polls many MetricsCollectors at once on a bounded thread pool.
+    # A slow or hung instance only ever holds its own worker; the cycle returns
+    # once every target finished or ran past its timeout.
+
+    def __init__(self, collectors, max_workers=8, target_timeout=30):
+        self.collectors = collectors
+        self.max_workers = max(1, min(max_workers, len(collectors) or 1))
+        self.target_timeout = target_timeout
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="collector")
+        # instance -> future of a collection that overran its timeout and is still running
+        self.in_flight = {}
+        self.logger = logging.getLogger("CollectionScheduler")
+
+    def _run_target(self, collector, started, submitted_at):
+        started[collector.instance] = time.monotonic()
+        # Time spent queued behind other targets: a sign the pool is too small
+        EXPORTER_SCHEDULER_LAG.labels(collector.instance).set(started[collector.instance] - submitted_at)
+        collector.collect()
+
+    def run_cycle(self):
+        with EXPORTER_CYCLE_DURATION.time():
+            self._run_cycle()
+
+    def _run_cycle(self):
+        started = {}
+        pending = {}
+        for collector in self.collectors:
+            previous = self.in_flight.get(collector.instance)
+            if previous is not None:
+                if not previous.done():
+                    self.logger.warning(f"[{collector.instance}] Previous collection still running, skipping this cycle")
+                    EXPORTER_TARGET_TIMEOUTS.labels(collector.instance).inc()
+                    continue
+                del self.in_flight[collector.instance]
+            future = self.executor.submit(self._run_target, collector, started, time.monotonic())
+            pending[future] = collector
+
+        # Targets queued behind a full pool start late, so the cycle as a whole
+        # gets one timeout per "wave" of workers.
+        waves = math.ceil(len(pending) / self.max_workers) if pending else 0
+        cycle_deadline = time.monotonic() + self.target_timeout * max(1, waves)
+
+        while pending:
+            now = time.monotonic()
+            next_check = cycle_deadline - now
+            for future, collector in pending.items():
+                start = started.get(collector.instance)
+                if start is not None:
+                    next_check = min(next_check, start + self.target_timeout - now)
+
+            done, _ = wait(list(pending), timeout=max(0, next_check), return_when=FIRST_COMPLETED)
+            for future in done:
+                collector = pending.pop(future)
+                error = future.exception()
+                if error is not None:
+                    self.logger.error(f"[{collector.instance}] Collection failed: {error}")
+
+            now = time.monotonic()
+            for future, collector in list(pending.items()):
+                start = started.get(collector.instance)
+                if start is not None and now - start >= self.target_timeout:
+                    self.logger.warning(f"[{collector.instance}] Collection exceeded {self.target_timeout}s timeout, moving on")
+                    EXPORTER_TARGET_TIMEOUTS.labels(collector.instance).inc()
+                    self.in_flight[collector.instance] = future
+                    del pending[future]
+                elif start is None and now >= cycle_deadline:
+                    # Never got a worker (pool held by hung targets); try again next cycle
+                    if not future.cancel():
+                        self.in_flight[collector.instance] = future
+                    self.logger.warning(f"[{collector.instance}] No free worker before cycle deadline, skipping")
+                    EXPORTER_TARGET_TIMEOUTS.labels(collector.instance).inc()
+                    del pending[future]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for collector in self.collectors:
+            collector.close()
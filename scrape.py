@@ -0,0 +1,57 @@
+import logging
+import threading
+import time
+
+
+class OnDemandCollector:
+    # prometheus_client custom collector for pull mode: the SQL Servers are
+    # queried when /metrics is scraped instead of on a fixed loop.
+    #
+    # Scrapes arriving while a refresh is in flight wait for that refresh instead
+    # of starting their own, and a finished refresh is reused for `cache_ttl`
+    # seconds, so HA Prometheus pairs (or a curl during a scrape) cost one
+    # round of queries and see the same snapshot.
+
+    def __init__(self, refresh, metrics, cache_ttl=5):
+        self.refresh = refresh
+        self.metrics = metrics
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.in_flight = None       # Event set when the running refresh finishes
+        self.refreshed_at = None
+        self.logger = logging.getLogger("OnDemandCollector")
+
+    def _refresh(self):
+        with self.lock:
+            if self.refreshed_at is not None and time.monotonic() - self.refreshed_at < self.cache_ttl:
+                return
+            done = self.in_flight
+            leader = done is None
+            if leader:
+                done = self.in_flight = threading.Event()
+
+        if not leader:
+            done.wait()
+            return
+
+        try:
+            start_time = time.time()
+            self.refresh()
+            self.logger.info(f"Metrics collected on scrape in {time.time() - start_time:.2f}s")
+        except Exception as e:
+            self.logger.error(f"Collection on scrape failed: {e}")
+        finally:
+            with self.lock:
+                self.refreshed_at = time.monotonic()
+                self.in_flight = None
+            done.set()
+
+    def describe(self):
+        # Lets the registry check for duplicate names without triggering a collection
+        for metric in self.metrics:
+            yield from metric.describe()
+
+    def collect(self):
+        self._refresh()
+        for metric in self.metrics:
+            yield from metric.collect()
@@ -0,0 +1,37 @@
+class SeriesTracker:
+    # Generation-based eviction of label sets that stop showing up.
+    #
+    # prometheus_client keeps every label set ever passed to .labels() until it is
+    # removed explicitly. A collector calls begin() before a refresh, sets values
+    # through labels() (which marks the label set as seen in this generation), and
+    # sweep() once the refresh succeeded: every label set not seen is removed.
+    # If a refresh fails half way, sweep() is never called and nothing is evicted.
+
+    def __init__(self, *metrics):
+        self.metrics = metrics
+        self.seen = {metric: {} for metric in metrics}  # metric -> {labelvalues: generation}
+        self.generation = 0
+
+    def begin(self):
+        self.generation += 1
+
+    def labels(self, metric, *labelvalues):
+        labelvalues = tuple(str(v) for v in labelvalues)
+        self.seen[metric][labelvalues] = self.generation
+        return metric.labels(*labelvalues)
+
+    def sweep(self):
+        removed = 0
+        for metric, seen in self.seen.items():
+            stale = [labelvalues for labelvalues, generation in seen.items() if generation != self.generation]
+            for labelvalues in stale:
+                del seen[labelvalues]
+                try:
+                    metric.remove(*labelvalues)
+                except KeyError:
+                    pass
+            removed += len(stale)
+        return removed
+
+    def __len__(self):
+        return sum(len(seen) for seen in self.seen.values())
@@ -0,0 +1,252 @@
+# Local spool of collected snapshots, for backfilling Prometheus after an outage
+# and for replaying a time range during incident forensics.
+#
+#   python spool.py --dir spool --start 2024-05-01T10:00 --end 2024-05-01T11:00 > replay.om
+#   promtool tsdb create-blocks-from openmetrics replay.om ./data
+#
+# Each cycle's samples are appended to the current segment file. A series is
+# written out once per segment (id + exposition text) and referenced by its
+# 4-byte id afterwards, so a sample costs 12 bytes and every segment can be
+# read on its own. Segments rotate by size and age and the oldest
+# are deleted past the retention limits. Readers memory-map whole segments.
+import argparse
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from datetime import datetime
+
+MAGIC = b'SQLSPL01'
+RECORD = struct.Struct('<BI')     # kind, payload length
+SERIES = 1                        # payload: <I id> + utf-8 series text
+SAMPLES = 2                       # payload: <d timestamp><I count> + count ids (I) + count values (d)
+SAMPLES_HEADER = struct.Struct('<dI')
+SERIES_ID = struct.Struct('<I')
+SEGMENT_PATTERN = re.compile(r'^segment-(\d+)\.spl$')
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _native(values):
+    # Records are little-endian; arrays use the machine's byte order
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def series_text(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + '}'
+
+
+class Spool:
+    # Append-only writer. Not thread-safe: one writer per directory (the collection loop).
+
+    def __init__(self, directory, segment_max_bytes=16 * 1024 * 1024, segment_max_seconds=3600,
+                 retention_hours=48, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_seconds = segment_max_seconds
+        self.retention_seconds = retention_hours * 3600
+        self.max_bytes = max_bytes
+        self.file = None
+        self.series = {}
+        # Newest timestamp written per series that carries its own (e.g. CPU history). Such
+        # samples stay exposed for several cycles; each one is written once, so replayed
+        # series have increasing timestamps as OpenMetrics requires.
+        self.written_until = {}
+        self.logger = logging.getLogger("Spool")
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_segment(self, timestamp):
+        if self.file is not None:
+            self.file.close()
+        path = os.path.join(self.directory, f"segment-{int(timestamp * 1000):015d}.spl")
+        self.file = open(path, 'ab')
+        self.file.write(MAGIC)
+        self.opened_at = timestamp
+        self.series = {}
+        self._apply_retention(timestamp)
+
+    def _apply_retention(self, now):
+        segments = list_segments(self.directory)
+        total = sum(size for _, _, size in segments)
+        # The newest segment is the one just opened and is never removed
+        for path, start, size in segments[:-1]:
+            if total <= self.max_bytes and start >= now - self.retention_seconds:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError as e:
+                self.logger.warning(f"Failed to remove spool segment {path}: {e}")
+
+    def write(self, timestamp, samples):
+        # samples: iterable of (name, labels dict, value, sample timestamp or None).
+        # Samples with their own timestamp (e.g. CPU history) are kept under it.
+        if (self.file is None or self.file.tell() >= self.segment_max_bytes
+                or timestamp - self.opened_at >= self.segment_max_seconds):
+            self._open_segment(timestamp)
+
+        batches = {}
+        out = []
+        for name, labels, value, sample_timestamp in samples:
+            key = (name, tuple(sorted(labels.items())))
+            if sample_timestamp is not None:
+                if sample_timestamp <= self.written_until.get(key, float('-inf')):
+                    continue
+                self.written_until[key] = sample_timestamp
+            series_id = self.series.get(key)
+            if series_id is None:
+                series_id = self.series[key] = len(self.series)
+                payload = SERIES_ID.pack(series_id) + series_text(name, labels).encode('utf-8')
+                out.append(RECORD.pack(SERIES, len(payload)) + payload)
+            batch = batches.get(sample_timestamp or timestamp)
+            if batch is None:
+                batch = batches[sample_timestamp or timestamp] = (array('I'), array('d'))
+            batch[0].append(series_id)
+            batch[1].append(value)
+
+        for batch_timestamp, (ids, values) in sorted(batches.items()):
+            payload = SAMPLES_HEADER.pack(batch_timestamp, len(ids)) + _native(ids).tobytes() + _native(values).tobytes()
+            out.append(RECORD.pack(SAMPLES, len(payload)) + payload)
+        self.file.write(b''.join(out))
+        # Flushed every cycle so a crash loses at most the cycle being written
+        self.file.flush()
+
+    def write_snapshot(self, timestamp, metrics):
+        # Current samples of prometheus_client metrics
+        self.write(timestamp, (
+            (sample.name, sample.labels, sample.value, sample.timestamp)
+            for metric in metrics
+            for family in metric.collect()
+            for sample in family.samples
+            if not sample.name.endswith('_created')
+        ))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def list_segments(directory):
+    # [(path, start timestamp, size)] oldest first
+    segments = []
+    for name in os.listdir(directory):
+        match = SEGMENT_PATTERN.match(name)
+        if match:
+            path = os.path.join(directory, name)
+            segments.append((path, int(match.group(1)) / 1000.0, os.path.getsize(path)))
+    return sorted(segments, key=lambda segment: segment[1])
+
+
+def read_segment(path, start=None, end=None):
+    # Yields (timestamp, series text, value) from one segment, in write order.
+    # A record cut short (the writer is mid-cycle, or crashed) ends the segment.
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= len(MAGIC):
+            return
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a spool segment")
+            series = {}
+            offset = len(MAGIC)
+            while offset + RECORD.size <= size:
+                kind, length = RECORD.unpack_from(mm, offset)
+                offset += RECORD.size
+                if offset + length > size:
+                    return
+                if kind == SERIES:
+                    series_id, = SERIES_ID.unpack_from(mm, offset)
+                    series[series_id] = mm[offset + SERIES_ID.size:offset + length].decode('utf-8')
+                elif kind == SAMPLES:
+                    timestamp, count = SAMPLES_HEADER.unpack_from(mm, offset)
+                    if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                        ids_at = offset + SAMPLES_HEADER.size
+                        values_at = ids_at + 4 * count
+                        ids = _native(array('I', mm[ids_at:values_at]))
+                        values = _native(array('d', mm[values_at:values_at + 8 * count]))
+                        for series_id, value in zip(ids, values):
+                            yield timestamp, series[series_id], value
+                offset += length
+
+
+def replay(directory, start=None, end=None, match=None):
+    # (timestamp, series text, value) for every spooled sample in [start, end]
+    segments = list_segments(directory)
+    for i, (path, segment_start, _) in enumerate(segments):
+        # A segment covers the time until the next one starts
+        segment_end = segments[i + 1][1] if i + 1 < len(segments) else None
+        if end is not None and segment_start > end:
+            break
+        if start is not None and segment_end is not None and segment_end < start:
+            continue
+        for timestamp, series, value in read_segment(path, start, end):
+            if match is None or match.search(series):
+                yield timestamp, series, value
+
+
+def to_openmetrics(samples):
+    # OpenMetrics text with timestamps, as read by `promtool tsdb create-blocks-from openmetrics`.
+    # Samples are grouped per name and series (OpenMetrics doesn't allow interleaving either)
+    # and typed 'unknown' so counter samples can keep their _total names.
+    families = {}
+    for timestamp, series, value in samples:
+        family = families.setdefault(series.split('{', 1)[0], {})
+        family.setdefault(series, []).append(f"{series} {_format_value(value)} {timestamp:.3f}")
+    lines = []
+    for name, family in families.items():
+        lines.append(f"# TYPE {name} unknown")
+        for series_lines in family.values():
+            lines.extend(series_lines)
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def parse_time(value):
+    # Epoch seconds or ISO 8601 (local time unless an offset is given)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay spooled exporter snapshots')
+    parser.add_argument('--dir', default='spool', help='Spool directory')
+    parser.add_argument('--start', help='Epoch seconds or ISO 8601 time')
+    parser.add_argument('--end', help='Epoch seconds or ISO 8601 time')
+    parser.add_argument('--match', help='Only series matching this regular expression')
+    parser.add_argument('--list', action='store_true', help='List segments instead of replaying')
+    args = parser.parse_args()
+
+    if args.list:
+        for path, start, size in list_segments(args.dir):
+            print(f"{datetime.fromtimestamp(start).isoformat(timespec='seconds')}  {size / 1024:10.1f} KB  {path}")
+        return
+    match = re.compile(args.match) if args.match else None
+    sys.stdout.write(to_openmetrics(replay(args.dir, parse_time(args.start), parse_time(args.end), match)))
+
+
+if __name__ == '__main__':
+    main()
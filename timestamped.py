@@ -0,0 +1,55 @@
+import threading
+import time
+from collections import deque
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+
+class TimestampedGauge:
+    # Gauge whose samples carry the time they were measured on the server,
+    # for data that arrives in batches (e.g. the per-minute CPU records of the
+    # scheduler monitor ring buffer, several of which come in after an outage).
+    #
+    # Each sample is exposed with its own timestamp for `retention` seconds after
+    # it was collected, long enough for every scraper to pick it up once, then
+    # dropped. Prometheus ignores re-scraped samples with an unchanged timestamp.
+
+    def __init__(self, name, documentation, labelnames, retention=300, max_samples=512, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.retention = retention
+        self.max_samples = max_samples
+        self.samples = {}  # labelvalues -> deque of (collected_at, timestamp, value)
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def add(self, labelvalues, timestamp, value):
+        labelvalues = tuple(str(v) for v in labelvalues)
+        with self.lock:
+            samples = self.samples.get(labelvalues)
+            if samples is None:
+                samples = self.samples[labelvalues] = deque(maxlen=self.max_samples)
+            samples.append((time.monotonic(), timestamp, value))
+
+    def remove(self, *labelvalues):
+        with self.lock:
+            self.samples.pop(tuple(str(v) for v in labelvalues), None)
+
+    def describe(self):
+        yield GaugeMetricFamily(self.name, self.documentation, labels=self.labelnames)
+
+    def collect(self):
+        family = GaugeMetricFamily(self.name, self.documentation, labels=self.labelnames)
+        expired_before = time.monotonic() - self.retention
+        with self.lock:
+            for labelvalues, samples in list(self.samples.items()):
+                while samples and samples[0][0] < expired_before:
+                    samples.popleft()
+                if not samples:
+                    del self.samples[labelvalues]
+                    continue
+                for _, timestamp, value in samples:
+                    family.add_metric(labelvalues, value, timestamp=timestamp)
+        yield family
@@ -0,0 +1,129 @@
+import hashlib
+import heapq
+from deltas import CounterDeltas
+from fingerprints import query_hash_fingerprint
+
+# Cumulative columns tracked per statement, in the order passed to add()
+STAT_FIELDS = ('execution_count', 'total_worker_time', 'total_logical_io', 'total_elapsed_time')
+EXECUTIONS, CPU, IO, DURATION = range(len(STAT_FIELDS))
+
+
+class QueryAggregate:
+    # Interval totals of every cached statement sharing one fingerprint in one database
+    __slots__ = ('fingerprint', 'database', 'totals', 'key', 'plan_handle', 'query_plan_hash', 'heaviest')
+
+    def __init__(self, fingerprint, database, key, plan_handle, query_plan_hash, deltas):
+        self.fingerprint = fingerprint
+        self.database = database
+        self.totals = list(deltas)
+        # Statement with the most CPU in the interval; its text represents the fingerprint
+        self.key = key
+        self.plan_handle = plan_handle
+        self.query_plan_hash = query_plan_hash
+        self.heaviest = deltas[CPU]
+
+    def add(self, key, plan_handle, query_plan_hash, deltas):
+        for i, delta in enumerate(deltas):
+            self.totals[i] += delta
+        if deltas[CPU] > self.heaviest:
+            self.key = key
+            self.plan_handle = plan_handle
+            self.query_plan_hash = query_plan_hash
+            self.heaviest = deltas[CPU]
+
+
+def handle_fingerprint(query_hash, key):
+    # Statements without a query_hash are identified by their (sql_handle, offsets)
+    # key, or for Query Store by (database, plan_id)
+    fingerprint = query_hash_fingerprint(query_hash)
+    if fingerprint:
+        return fingerprint
+    sql_handle, start, end = key
+    if isinstance(sql_handle, str):
+        return hashlib.blake2b(f"{sql_handle}:{start}".encode(), digest_size=8).hexdigest()
+    return hashlib.blake2b(bytes(sql_handle or b'') + f":{start}:{end}".encode(), digest_size=8).hexdigest()
+
+
+class QueryStatsTracker:
+    # Incremental top-N over sys.dm_exec_query_stats.
+    #
+    # Every pass feeds the lifetime totals of each cached statement, keyed by
+    # (sql_handle, statement_start_offset, statement_end_offset). The previous
+    # totals live in a CounterDeltas table, so each pass yields what every
+    # statement consumed since the last one; statements are then summed per
+    # (fingerprint, database) and ranked by interval CPU, I/O, duration and executions.
+    # Statements evicted from the plan cache are swept from the table.
+    #
+    # The plan cache doesn't say which database a statement ran in. Statements that
+    # became active are looked up once after the pass (unresolved() / resolve()) and
+    # remembered by key until they are swept; Query Store keys carry their database.
+
+    def __init__(self):
+        self.stats = CounterDeltas(STAT_FIELDS)
+        self.primed = False
+        self.aggregates = {}
+        self.active = []
+        self.databases = {}
+
+    def begin(self, now):
+        self.now = now
+        self.aggregates = {}
+        self.active = []
+
+    def add(self, key, query_hash, query_plan_hash, plan_handle, counters, baseline=False, database=None):
+        # `baseline`: the key's source is read for the first time, so a key not seen
+        # before only records its totals, like every key on the first pass
+        sample = self.stats.update(key, counters, self.now)
+        if sample is None:
+            if not self.primed or baseline:
+                return
+            # Not cached at the previous pass, so it was compiled since: all of its totals are new
+            deltas = counters
+        else:
+            deltas = sample[0]
+        if deltas[EXECUTIONS] <= 0 and deltas[CPU] <= 0:
+            return  # Idle since the last pass; the vast majority of the plan cache
+        self.active.append((key, query_hash, query_plan_hash, plan_handle, deltas, database))
+
+    def unresolved(self):
+        # Plan handles of active statements whose database isn't known yet
+        return {
+            plan_handle for key, _, _, plan_handle, _, database in self.active
+            if database is None and plan_handle is not None and key not in self.databases
+        }
+
+    def resolve(self, plan_databases):
+        # plan_databases: plan_handle -> database, from the lookup of unresolved()
+        for key, _, _, plan_handle, _, database in self.active:
+            if database is None and key not in self.databases and plan_databases.get(plan_handle):
+                self.databases[key] = plan_databases[plan_handle]
+
+    def finish(self, keep=None):
+        # Returns False after the first pass, which only records the baseline.
+        # keep(key): keys to hold on to although this pass didn't see them.
+        self.stats.sweep(keep)
+        for key in [key for key in self.databases if key not in self.stats.index]:
+            del self.databases[key]
+        if not self.primed:
+            self.primed = True
+            return False
+
+        for key, query_hash, query_plan_hash, plan_handle, deltas, database in self.active:
+            # A statement whose plan was evicted before the lookup stays unlabelled
+            # this time and is looked up again when it shows up next
+            database = database or self.databases.get(key)
+            fingerprint = handle_fingerprint(query_hash, key)
+            aggregate = self.aggregates.get((fingerprint, database))
+            if aggregate is None:
+                self.aggregates[fingerprint, database] = QueryAggregate(fingerprint, database, key, plan_handle, query_plan_hash, deltas)
+            else:
+                aggregate.add(key, plan_handle, query_plan_hash, deltas)
+        self.active = []
+        return True
+
+    def top(self, field, limit):
+        ranked = heapq.nlargest(limit, self.aggregates.values(), key=lambda aggregate: aggregate.totals[field])
+        return [aggregate for aggregate in ranked if aggregate.totals[field] > 0]
+
+    def __len__(self):
+        return len(self.stats)
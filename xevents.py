@@ -0,0 +1,77 @@
+import re
+
+# Extended Events counted by the xevents collector, by event name
+DEADLOCK_EVENTS = ('xml_deadlock_report',)
+LOCK_TIMEOUT_EVENTS = ('lock_timeout', 'lock_timeout_greater_than_0')
+ERROR_EVENTS = ('error_reported',)
+# Error 1222 (lock request time out period exceeded) is what a lock timeout
+# looks like to a session that only captures error_reported; it is counted as
+# one only for such sessions, so a timeout isn't counted twice
+LOCK_TIMEOUT_ERROR = 1222
+ERROR_FIELDS = ('error_number', 'severity')
+
+# Error 25718: the event file read last is gone (deleted after a rollover)
+FILE_NOT_FOUND_ERROR = 25718
+# SQL Server error numbers in a driver message, e.g. "... is invalid. (25718) (SQLExecDirectW)"
+ERROR_NUMBER = re.compile(r'\((\d+)\)')
+
+# Characters fed to the parser at a time
+CHUNK_SIZE = 4096
+
+
+def event_fields(event_data, names):
+    # Values of the named <data> fields of one event's XML. The event is fed to a
+    # pull parser in chunks and parsing stops once every field has been seen, so
+    # payload fields after them (message text, stacks) are never parsed.
+    # (Imported here: ElementTree is only needed once an error event arrives.)
+    from xml.etree.ElementTree import XMLPullParser
+    parser = XMLPullParser(events=('end',))
+    fields = {}
+    for start in range(0, len(event_data), CHUNK_SIZE):
+        parser.feed(event_data[start:start + CHUNK_SIZE])
+        for _, element in parser.read_events():
+            if element.tag == 'data' and element.get('name') in names:
+                value = element.find('value')
+                fields[element.get('name')] = value.text if value is not None else None
+                if len(fields) == len(names):
+                    return fields
+    return fields
+
+
+def is_file_not_found(error):
+    message = str(error.args[1]) if len(error.args) > 1 else ''
+    return str(FILE_NOT_FOUND_ERROR) in ERROR_NUMBER.findall(message)
+
+
+class EventCounts:
+    # Deadlocks, lock timeouts and errors counted from a batch of events
+
+    __slots__ = ('deadlocks', 'lock_timeouts', 'errors', 'lock_timeout_errors')
+
+    def __init__(self, lock_timeout_errors=True):
+        self.deadlocks = 0
+        self.lock_timeouts = 0
+        self.errors = {}  # (error_number, severity) -> count
+        # False when the session captures lock_timeout events itself
+        self.lock_timeout_errors = lock_timeout_errors
+
+    def add(self, event_name, event_data):
+        if event_name in DEADLOCK_EVENTS:
+            self.deadlocks += 1
+        elif event_name in LOCK_TIMEOUT_EVENTS:
+            self.lock_timeouts += 1
+        elif event_name in ERROR_EVENTS and event_data:
+            fields = event_fields(event_data, ERROR_FIELDS)
+            try:
+                key = (int(fields['error_number']), int(fields['severity']))
+            except (KeyError, TypeError, ValueError):
+                return
+            if key[0] == LOCK_TIMEOUT_ERROR and self.lock_timeout_errors:
+                self.lock_timeouts += 1
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def merge(self, other):
+        self.deadlocks += other.deadlocks
+        self.lock_timeouts += other.lock_timeouts
+        for key, count in other.errors.items():
+            self.errors[key] = self.errors.get(key, 0) + count